@@ -8,14 +8,32 @@ Authors: Johnfil Initan, Vince Abella, Jake Perez
 
 """
 
+import hashlib
+import threading
+
 import numpy as np
 
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush, heappushpop
+
+from scipy.cluster.hierarchy import linkage
+from scipy.linalg import eigh
 from scipy.signal import argrelextrema
+from scipy.sparse import coo_matrix, issparse, triu
+from scipy.spatial.distance import squareform
 from scipy.stats import gaussian_kde
 
 from sklearn.cluster import KMeans
-from sklearn.cluster import AgglomerativeClustering
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.cluster import AffinityPropagation
+from sklearn.utils.extmath import randomized_svd
+
+from Models._pairs import ClusterGapView, PairTable, pair_index, pair_items
+
+# average linkage trees of recently clustered timegap matrices
+MAX_LINKAGE_TREES = 4
+_linkage_trees = OrderedDict()
+_linkage_lock = threading.Lock()
 
 ########################################################
 # Data Processing
@@ -62,7 +80,131 @@ def initialize_timegap(L=list, default_timegap=float):
 
     return TD, TH
 
-def add_timegap(df, TD=dict, TH=dict, appended=False):
+def good_status_mask(status):
+    '''
+    Flags the rows whose status signifies good data, i.e. the
+    status is a number, a string of digits, 'Good', or missing.
+    Every row of a numeric column is good, whatever its sign.
+
+    Parameters
+    -----------
+    status : Series
+        The status column of a DataFrame of shopping lists. A
+        boolean column is taken as the mask itself, as given
+        by load_recording.
+
+    Returns
+    -----------
+    mask : NumPy array (bool)
+        True for every row that is considered good data.
+
+    '''
+    if status.dtype.kind == 'b':
+        return status.to_numpy(dtype=bool)
+
+    if status.dtype.kind in 'iuf':
+        return np.ones(len(status), dtype=bool)
+
+    text = status.astype(str)
+    mask = text.str.isdigit() | (text == 'Good') | status.isna()
+    if status.dtype == object:
+        mask |= status.map(lambda x: isinstance(x, (int, float)))
+
+    return mask.to_numpy(dtype=bool)
+
+def extract_timegaps(df, lists=False):
+    '''
+    Extracts the timegaps of all consecutive pairs of items
+    in a bulk file of shopping lists, using array operations
+    instead of walking the DataFrame row by row. The pairs are
+    returned in the same order that add_timegap visits them.
+
+    Parameters
+    -----------
+    df : DataFrame
+        Contains three columns: item, timestamp, status.
+        A timestamp of 0 marks the first item of a list. A
+        categorical item column is extracted by its codes.
+
+    lists : Boolean, default=False
+        Also returns the list of each pair.
+
+    Returns
+    -----------
+    items : NumPy array
+        Sorted unique items of all rows with good status.
+
+    I : NumPy array (int)
+        Index in items of the first item of each pair.
+
+    J : NumPy array (int)
+        Index in items of the second item of each pair,
+        where I < J so that (items[I], items[J]) is sorted.
+
+    D : NumPy array (float)
+        Timegap between the two items of each pair.
+
+    n_lists : int
+        The total number of lists.
+
+    K : NumPy array (int)
+        Index of the list of each pair, counting from 0, if
+        lists is True.
+
+    '''
+    timestamps = df.iloc[:, 1].to_numpy(dtype=float)
+    timestamps_next = np.zeros(len(timestamps))
+    timestamps_next[:-1] = timestamps[1:]
+
+    rows = np.flatnonzero(good_status_mask(df.iloc[:, 2]))
+    column = df.iloc[:, 0]
+    if column.dtype.name == 'category':
+        used, codes = np.unique(column.cat.codes.to_numpy()[rows], return_inverse=True)
+        items = np.asarray(column.cat.categories, dtype=object)[used]
+        order = np.argsort(items, kind='stable')
+        items, codes = items[order], np.argsort(order)[codes.ravel()]
+    else:
+        items, codes = np.unique(column.to_numpy()[rows], return_inverse=True)
+    codes = codes.ravel()
+    timestamps = timestamps[rows]
+    timestamps_next = timestamps_next[rows]
+    n_rows = len(rows)
+
+    starts = timestamps == 0
+    n_lists = int(starts.sum())
+
+    # each list spans from its last start up to a row followed by a
+    # timestamp of 0, which is where add_timegap emits its pairs
+    first = np.maximum.accumulate(np.where(starts, np.arange(n_rows), 0))
+    ends = np.flatnonzero(timestamps_next == 0)
+    lengths = ends - first[ends] + 1
+    span = np.repeat(np.arange(len(ends)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(offsets - first[ends], lengths)
+
+    # repeated items keep their first position but take their last timestamp
+    keys = span * len(items) + codes[positions]
+    unique_keys, first_seen = np.unique(keys, return_index=True)
+    _, last_seen = np.unique(keys[::-1], return_index=True)
+    last_seen = len(keys) - 1 - last_seen
+
+    order = np.argsort(first_seen, kind='stable')
+    span = unique_keys[order] // max(len(items), 1)
+    codes = unique_keys[order] % max(len(items), 1)
+    values = timestamps[positions[last_seen[order]]]
+
+    same_list = span[1:] == span[:-1]
+    key1, key2 = codes[:-1][same_list], codes[1:][same_list]
+    D = np.abs(values[:-1][same_list] - values[1:][same_list])
+
+    if lists:
+        # lists are counted by their starts, like n_lists
+        list_index = np.maximum(np.cumsum(starts)[first[ends]] - 1, 0)
+        K = list_index[span[:-1][same_list]]
+        return items, np.minimum(key1, key2), np.maximum(key1, key2), D, n_lists, K
+    return items, np.minimum(key1, key2), np.maximum(key1, key2), D, n_lists
+
+def add_timegap(df, TD=dict, TH=dict, appended=False, vectorized=False):
     '''
     Adds dictionary of timegaps with default values.
 
@@ -88,6 +230,11 @@ def add_timegap(df, TD=dict, TH=dict, appended=False):
         Determines if list is single or is a bulk file of
         multiple lists appended together.
 
+    vectorized : Boolean, default=False
+        Extracts the pairs with extract_timegaps instead of
+        iterating over the rows of the DataFrame. Both modes
+        give the same timegaps.
+
     Returns
     -----------
     TD : dictionary (string, list)
@@ -101,7 +248,14 @@ def add_timegap(df, TD=dict, TH=dict, appended=False):
     temp = {}
     n_lists = 0
 
-    if appended == True:
+    if appended == True and vectorized == True:
+        items, I, J, D, n_lists = extract_timegaps(df)
+        for i, j, diff in zip(I.tolist(), J.tolist(), D.tolist()):
+            pair = (items[i], items[j])
+            TD = check_timegap(TD, TH, pair, diff)
+            TD[pair].append(diff)
+
+    elif appended == True:
         for index in range(len(df)):
             item = df.iloc[index, 0]
             timestamp = df.iloc[index, 1]
@@ -178,7 +332,7 @@ def check_timegap(TD=dict, TH=dict, key=tuple, value=int):
             TH[key] += 1
             if TH[key] >= 3:
                 TD[key] = [sum(TD[key][-3:]) / len(TD[key][-3:])]
-                TH[key] == 0
+                TH[key] = 0
 
         TD[key].append(value)
     else:
@@ -211,6 +365,55 @@ def normalize_timegaps(TD=dict):
 
     return TD
 
+def add_timegap_table(df, PT=PairTable, appended=False, timestamp=None):
+    '''
+    Adds the timegaps of a bulk file of shopping lists to a
+    pair table. This is the array-backed counterpart of
+    add_timegap followed by normalize_timegaps, and gives the
+    same timegaps.
+
+    Parameters
+    -----------
+    df : DataFrame
+        Contains three columns: item, timestamp, status.
+
+    PT : PairTable
+        Timegaps and thresholds of every pair of items.
+        Pairs with items outside of its vocabulary are skipped.
+
+    appended : Boolean, default=False
+        Determines if list is single or is a bulk file of
+        multiple lists appended together.
+
+    timestamp : float, default=None
+        Wall-clock time of the lists, e.g. when they were
+        recorded, for a table whose half-life is in seconds.
+        By default every list is timed by its shopper index
+        since the table was created, so the half-life is
+        counted in shoppers.
+
+    Returns
+    -----------
+    PT : PairTable
+        Timegaps and thresholds of every pair of items.
+
+    n_lists : int, default=0
+        The total number of lists.
+
+    '''
+    n_lists = 0
+
+    if appended == True:
+        items, I, J, D, n_lists, K = extract_timegaps(df, lists=True)
+        ids = PT.encode(items)
+        I, J = ids[I], ids[J]
+        known = (I >= 0) & (J >= 0)
+        T = PT.n_lists + K[known] if timestamp is None else timestamp
+        PT.add_timegaps(pair_index(I[known], J[known], PT.n_items), D[known], T)
+        PT.n_lists += n_lists
+
+    return PT, n_lists
+
 def dict_to_matrix(L=list, TD=dict):
     '''
     Converts dictionary to matrix format where rows [i] is
@@ -247,31 +450,833 @@ def dict_to_matrix(L=list, TD=dict):
     
     return TX
 
-def distance_to_similarity_matrix(distance_matrix, alpha=0.1):
+def table_to_matrix(PT=PairTable, L=None, condensed=False, statistic=None):
+    '''
+    Converts a pair table to a float32 distance matrix by
+    scattering the condensed timegaps of the table, instead
+    of looking up every cell in a dictionary.
+
+    Parameters
+    -----------
+    PT : PairTable
+        Timegaps of every pair of items.
+
+    L : list, default=None
+        List of items that act as datapoints. Defaults to the
+        items of the table. Pairs with items outside of the
+        table are given a timegap of 0, as in dict_to_matrix.
+
+    condensed : Boolean, default=False
+        Returns the upper triangle of the matrix as a condensed
+        vector, as used by scipy.spatial.distance.squareform,
+        instead of the full square matrix.
+
+    statistic : str, default=None
+        The timegap statistic of the table to use, as taken
+        by PairTable.statistic. Defaults to the most robust
+        statistic the table keeps.
+
+    Returns
+    -----------
+    TX : distance matrix (NumPy array)
+        The rows [i] and columns [j] represent a list of items,
+        thus, n_elements = n_features. Value at [i][j] represents
+        timegaps between items. If condensed, the timegap of the
+        items i < j is at pair_index(i, j, len(L)).
+
+    '''
+    values = PT.condensed(PT.statistic(statistic))
+    if L is None:
+        TX = values.astype(np.float32)
+    else:
+        ids = PT.encode(L)
+        I, J = np.triu_indices(len(L), k=1)
+        I, J = ids[I], ids[J]
+        known = (I >= 0) & (J >= 0) & (I != J)
+        TX = np.zeros(len(known), dtype=np.float32)
+        TX[known] = values[pair_index(I[known], J[known], PT.n_items)]
+
+    if condensed:
+        return TX
+
+    return squareform(TX, checks=False)
+
+def table_to_sparse(PT=PairTable, L=None, statistic=None):
+    '''
+    Converts a pair table to a sparse distance matrix holding
+    only the observed pairs. Every missing entry implicitly has
+    the default timegap, while the diagonal is implicitly 0.
+
+    Parameters
+    -----------
+    PT : PairTable
+        Timegaps of every pair of items, dense or sparse.
+
+    L : list, default=None
+        List of items that act as datapoints. Defaults to the
+        items of the table.
+
+    statistic : str, default=None
+        The timegap statistic of the table to use, as taken
+        by PairTable.statistic. Defaults to the most robust
+        statistic the table keeps.
+
+    Returns
+    -----------
+    TX : sparse distance matrix (SciPy CSR matrix)
+        Symmetric float32 matrix of the timegaps of observed
+        pairs. An observed timegap of 0 is stored explicitly.
+
+    '''
+    P = PT.observed()
+    values = PT.statistic(statistic)[PT.slots(P)].astype(np.float32)
+    I, J = pair_items(P, PT.n_items)
+    n_items = PT.n_items
+
+    if L is not None:
+        ids = PT.encode(L)
+        position = np.full(PT.n_items, -1, dtype=np.int64)
+        position[ids[ids >= 0]] = np.flatnonzero(ids >= 0)
+        I, J = position[I], position[J]
+        known = (I >= 0) & (J >= 0)
+        I, J, values = I[known], J[known], values[known]
+        n_items = len(L)
+
+    TX = coo_matrix((np.concatenate((values, values)), (np.concatenate((I, J)), np.concatenate((J, I)))),
+                    shape=(n_items, n_items), dtype=np.float32)
+
+    return TX.tocsr()
+
+def sparse_to_matrix(TX, default_timegap=10000):
+    '''
+    Expands a sparse distance matrix to a square float32
+    matrix, filling the missing entries with the default
+    timegap.
+
+    Parameters
+    -----------
+    TX : sparse distance matrix (SciPy sparse matrix)
+        Timegaps of observed pairs.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    TX : distance matrix (NumPy array)
+        The rows [i] and columns [j] represent a list of items.
+
+    '''
+    coo = TX.tocoo()
+    matrix = np.full(TX.shape, default_timegap, dtype=np.float32)
+    np.fill_diagonal(matrix, 0)
+    matrix[coo.row, coo.col] = coo.data
+
+    return matrix
+
+def distance_to_similarity_matrix(distance_matrix, alpha=0.1, default_timegap=10000):
     """
     Convert a distance matrix to a similarity matrix with exponential decay.
 
     Parameters
     ----------
     distance_matrix : numpy array
-        The input distance matrix.
+        The input distance matrix, either square or condensed.
+        A condensed matrix is decayed before it is expanded, so
+        the square distance matrix is never built. A sparse matrix
+        is decayed with its missing entries at default_timegap.
 
     alpha : float, optional
         Decay parameter controlling the rate of decay.
 
+    default_timegap : float, optional
+        Timegap of the missing entries of a sparse matrix.
+
     Returns
     -------
     similarity_matrix : numpy array
         The resulting similarity matrix.
     """
+    if issparse(distance_matrix):
+        coo = distance_matrix.tocoo()
+        similarity_matrix = np.full(coo.shape, np.exp(-alpha * default_timegap), dtype=np.float32)
+        similarity_matrix[coo.row, coo.col] = np.exp(-alpha * coo.data)
+        np.fill_diagonal(similarity_matrix, 1)  # Set diagonal elements to 1
+        return similarity_matrix
+
     similarity_matrix = np.exp(-alpha * distance_matrix)
+    if similarity_matrix.ndim == 1:
+        similarity_matrix = squareform(similarity_matrix, checks=False)
     np.fill_diagonal(similarity_matrix, 1)  # Set diagonal elements to 1
     return similarity_matrix
 
+def embed_timegaps(TX, n_components=10, method='svd', default_timegap=10000):
+    '''
+    Embeds the items in a few dimensions from their timegaps, so
+    that K-Means can run on n_components features instead of
+    the N columns of the distance matrix.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+
+    n_components : int, default=10
+        Number of dimensions of the embedding.
+
+    method : {'svd', 'mds'}, default='svd'
+        'svd' projects the centered rows of the distance matrix
+        on their top principal components with a randomized SVD.
+        These rows are the features K-Means used before, so the
+        distances between items are kept as far as n_components
+        dimensions allow. 'mds' is classical multidimensional
+        scaling, which places the items so that their euclidean
+        distances approximate the timegaps themselves.
+
+    default_timegap : float, default=10000
+        Timegap of the missing entries of a sparse matrix.
+
+    Returns
+    -----------
+    X : NumPy array
+        N x n_components coordinates of the items.
+
+    '''
+    if issparse(TX):
+        TX = sparse_to_matrix(TX, default_timegap)
+    elif TX.ndim == 1:
+        TX = squareform(TX, checks=False)
+
+    n_items = len(TX)
+    n_components = min(n_components, n_items)
+
+    if method == 'svd':
+        rows = TX - TX.mean(axis=0, dtype=np.float64).astype(TX.dtype)
+        U, S, _ = randomized_svd(rows, n_components, random_state=0)
+        return U * S
+    elif method == 'mds':
+        B = np.square(TX, dtype=np.float64)
+        B -= B.mean(axis=0)
+        B -= B.mean(axis=1)[:, None]
+        B *= -0.5
+        values, vectors = eigh(B, subset_by_index=[n_items - n_components, n_items - 1])
+        return vectors[:, ::-1] * np.sqrt(np.maximum(values[::-1], 0))
+    else:
+        raise ValueError(f"Unknown embedding method: {method}")
+
+def cut_linkage(Z, distance_threshold=None, n_clusters=None):
+    '''
+    Cuts an average linkage tree into flat clusters, numbering
+    the clusters the same way as AgglomerativeClustering.
+
+    Parameters
+    -----------
+    Z : NumPy array
+        Linkage matrix from scipy.cluster.hierarchy.linkage.
+
+    distance_threshold : float, default=None
+        The linkage distance threshold at or above which
+        clusters will not be merged. If not ``None``,
+        ``n_clusters`` must be ``None``.
+
+    n_clusters : int, default=None
+        The number of clusters to find. If not ``None``,
+        ``distance_threshold`` must be ``None``.
+
+    Returns
+    -----------
+    labels : NumPy array (int)
+        Cluster number of each datapoint.
+
+    n_clusters_ : int
+        The number of clusters found.
+
+    '''
+    if (n_clusters is None) == (distance_threshold is None):
+        raise ValueError("Exactly one of n_clusters and distance_threshold has to be set, and the other needs to be None.")
+
+    n_leaves = len(Z) + 1
+    children = Z[:, :2].astype(np.intp)
+
+    if distance_threshold is not None:
+        n_clusters = np.count_nonzero(Z[:, 2] >= distance_threshold) + 1
+    if n_clusters > n_leaves:
+        raise ValueError(f"Cannot extract {n_clusters} clusters from a tree with {n_leaves} leaves.")
+
+    # split the largest nodes first, as a heap of negated node numbers
+    nodes = [-(n_leaves + len(children) - 1)]
+    for _ in range(n_clusters - 1):
+        these_children = children[-nodes[0] - n_leaves]
+        heappush(nodes, -these_children[0])
+        heappushpop(nodes, -these_children[1])
+
+    # every node takes the cluster of its parent, walking down from the root
+    labels = np.full(n_leaves + len(children), -1, dtype=np.intp)
+    labels[[-node for node in nodes]] = np.arange(len(nodes))
+    for node in range(len(labels) - 1, n_leaves - 1, -1):
+        if labels[node] >= 0:
+            labels[children[node - n_leaves]] = labels[node]
+
+    return labels[:n_leaves], int(n_clusters)
+
+def observed_pairs(TX, default_timegap=10000):
+    '''
+    Lists the observed pairs of a timegap matrix once each,
+    without expanding a condensed or sparse matrix.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+        Entries equal to default_timegap, or missing from a
+        sparse matrix, were never observed.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    I, J : NumPy array (int)
+        Ids of the two items of each pair, where I < J.
+
+    values : NumPy array
+        Timegap of each pair.
+
+    n_items : int
+        The number of items in TX.
+
+    '''
+    if issparse(TX):
+        upper = triu(TX, k=1).tocoo()
+        observed = upper.data != default_timegap
+        return upper.row[observed], upper.col[observed], upper.data[observed], TX.shape[0]
+
+    if TX.ndim == 2:
+        TX = squareform(TX, checks=False)
+    n_items = int(np.ceil(np.sqrt(2 * len(TX))))
+    P = np.flatnonzero(TX != default_timegap)
+    I, J = pair_items(P, n_items)
+
+    return I, J, TX[P], n_items
+
+def knn_graph(TX, n_neighbors=10, default_timegap=10000):
+    '''
+    Builds a sparse k-nearest-neighbour connectivity graph from
+    the observed timegaps, keeping the n_neighbors shortest
+    timegaps of every item. An edge kept by either of its two
+    items is kept, so the graph is symmetric and has at most
+    N * n_neighbors pairs.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+        Entries equal to default_timegap, or missing from a
+        sparse matrix, were never observed.
+
+    n_neighbors : int, default=10
+        Number of neighbours kept for every item.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    TX : sparse distance matrix (SciPy CSR matrix)
+        Symmetric float32 timegaps of the kept pairs.
+
+    '''
+    I, J, values, n_items = observed_pairs(TX, default_timegap)
+
+    # every pair is a candidate neighbour of both of its items
+    rows = np.concatenate((I, J)).astype(np.int64)
+    cols = np.concatenate((J, I)).astype(np.int64)
+    values = np.concatenate((values, values)).astype(np.float32)
+
+    # rank the candidates of every item from the shortest timegap
+    order = np.lexsort((values, rows))
+    rows, cols, values = rows[order], cols[order], values[order]
+    starts = np.searchsorted(rows, np.arange(n_items))
+    kept = np.arange(len(rows)) - starts[rows] < n_neighbors
+
+    graph = coo_matrix((values[kept], (rows[kept], cols[kept])), shape=(n_items, n_items)).tocsr()
+
+    # keep an edge chosen by either item, with its timegap
+    return graph.maximum(graph.T).tocsr()
+
+def sparse_average_linkage(TX, default_timegap=10000):
+    '''
+    Builds an average linkage tree from a sparse distance
+    matrix, treating every missing entry as default_timegap
+    without storing it. Only clusters that share an observed
+    pair are ever compared, so the work grows with the number
+    of observed pairs instead of the square of the items.
+
+    Merges below default_timegap are the same as those of
+    scipy.cluster.hierarchy.linkage on the full matrix. The
+    remaining clusters are joined at default_timegap.
+
+    Given a graph from knn_graph, this is average linkage
+    constrained by the connectivity of the graph, since only
+    clusters joined by an edge can be merged.
+
+    Parameters
+    -----------
+    TX : sparse distance matrix (SciPy sparse matrix)
+        Symmetric timegaps of observed pairs.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    Z : NumPy array
+        Linkage matrix in the format of scipy.cluster.hierarchy.
+
+    '''
+    n_items = TX.shape[0]
+    upper = triu(TX, k=1).tocoo()
+
+    # neighbours[a][b] is the (sum, count) of observed timegaps between clusters a and b
+    neighbours = [{} for _ in range(n_items)]
+    sizes = [1] * n_items
+    active = [True] * n_items
+    heap = []
+
+    for a, b, value in zip(upper.row.tolist(), upper.col.tolist(), upper.data.tolist()):
+        neighbours[a][b] = neighbours[b][a] = (value, 1)
+        heap.append((value, a, b))
+    heapify(heap)
+
+    def average(stats, n_pairs):
+        total, count = stats
+        return (total + (n_pairs - count) * default_timegap) / n_pairs
+
+    Z = []
+    while heap and len(Z) < n_items - 1:
+        distance, a, b = heappop(heap)
+        if not (active[a] and active[b]):
+            continue
+        if distance > default_timegap:
+            break
+
+        node = n_items + len(Z)
+        active[a] = active[b] = False
+        Z.append((a, b, distance, sizes[a] + sizes[b]))
+
+        # merge the smaller neighbourhood into the larger one
+        small, large = sorted((neighbours[a], neighbours[b]), key=len)
+        merged = dict(large)
+        for other, (total, count) in small.items():
+            if other in merged:
+                merged[other] = (merged[other][0] + total, merged[other][1] + count)
+            else:
+                merged[other] = (total, count)
+        merged.pop(a, None)
+        merged.pop(b, None)
+
+        neighbours.append(merged)
+        sizes.append(sizes[a] + sizes[b])
+        active.append(True)
+        neighbours[a] = neighbours[b] = None
+
+        for other, stats in merged.items():
+            neighbours[other].pop(a, None)
+            neighbours[other].pop(b, None)
+            neighbours[other][node] = stats
+            heappush(heap, (average(stats, sizes[node] * sizes[other]), min(node, other), max(node, other)))
+
+    # clusters without observed pairs between them are joined last
+    height = max(default_timegap, Z[-1][2]) if Z else default_timegap
+    remaining = [node for node in range(len(active)) if active[node]]
+    node = remaining[0] if remaining else 0
+    for other in remaining[1:]:
+        sizes.append(sizes[node] + sizes[other])
+        Z.append((min(node, other), max(node, other), height, sizes[-1]))
+        node = len(sizes) - 1
+
+    return np.array(Z, dtype=np.float64).reshape(-1, 4)
+
+def linkage_tree(TX, default_timegap=10000, n_neighbors=0):
+    '''
+    Returns the average linkage tree of a timegap matrix. The
+    tree does not depend on where it is cut, so the trees of
+    the last few matrices are cached by their contents, and
+    clustering the same timegaps again with another threshold
+    or number of clusters only cuts the cached tree.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+        Missing entries of a sparse matrix are never observed.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    n_neighbors : int, default=0
+        If not 0, the tree is built on the knn_graph of TX with
+        this many neighbours.
+
+    Returns
+    -----------
+    Z : NumPy array
+        Read-only linkage matrix, as from
+        scipy.cluster.hierarchy.linkage.
+
+    '''
+    if issparse(TX):
+        TX = TX.tocsr()
+        parts = (TX.data, TX.indices, TX.indptr)
+    else:
+        TX = np.ascontiguousarray(TX)
+        parts = (TX,)
+
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(np.ascontiguousarray(part))
+    key = (issparse(TX), TX.shape, TX.dtype.str, default_timegap, n_neighbors, digest.hexdigest())
+
+    with _linkage_lock:
+        Z = _linkage_trees.get(key)
+        if Z is not None:
+            _linkage_trees.move_to_end(key)
+            return Z
+
+    if n_neighbors:
+        Z = sparse_average_linkage(knn_graph(TX, n_neighbors, default_timegap), default_timegap)
+    elif issparse(TX):
+        Z = sparse_average_linkage(TX, default_timegap)
+    elif TX.ndim == 1:
+        Z = linkage(TX, method='average')
+    else:
+        Z = linkage(squareform(TX, checks=False), method='average')
+    Z.flags.writeable = False
+
+    with _linkage_lock:
+        _linkage_trees[key] = Z
+        while len(_linkage_trees) > MAX_LINKAGE_TREES:
+            _linkage_trees.popitem(last=False)
+
+    return Z
+
+def sparse_affinity_propagation(TX, damping=0.5, max_iter=200, convergence_iter=15, alpha=0.1, default_timegap=10000):
+    '''
+    Affinity propagation that only passes messages along the
+    observed pairs of items, instead of over all N x N pairs.
+
+    The similarity of two items is the same as in the dense
+    affinity_propagation_clustering: the negative squared
+    euclidean distance between their rows of
+    distance_to_similarity_matrix. Unobserved timegaps decay
+    to 0 in those rows, so the rows are sparse, and the
+    similarities of the observed pairs are computed from them
+    exactly. Items that never shared a shopping list cannot
+    choose each other as exemplars.
+
+    The preference is the median similarity of all pairs, as
+    in sklearn. It is found without the dense matrix by
+    taking the unobserved similarities as -(|x_i|^2 + |x_j|^2),
+    which is what nearly all pairs are.
+
+    Responsibilities and availabilities are float32 arrays
+    aligned with the observed pairs, updated in place.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+
+    damping : float, default=0.5
+        Damping factor between 0.5 and 1.
+
+    max_iter : int, default=200
+        Maximum number of iterations.
+
+    convergence_iter : int, default=15
+        Number of iterations with no change in the exemplars
+        that stops the convergence.
+
+    alpha : float, default=0.1
+        Decay of distance_to_similarity_matrix.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    labels : NumPy array (int)
+        Cluster number of each datapoint, numbered in the order
+        of the exemplars. Items without an observed pair to any
+        exemplar are their own cluster. All labels are -1 if no
+        exemplar was found.
+
+    exemplars : NumPy array (int)
+        Index of the exemplar of every cluster.
+
+    '''
+    I, J, values, n_items = observed_pairs(TX, default_timegap)
+
+    # sparse similarity rows with the diagonal at 1, and their norms
+    decayed = np.exp(-alpha * values.astype(np.float64))
+    X = coo_matrix((np.concatenate((decayed, decayed, np.ones(n_items))),
+                    (np.concatenate((I, J, np.arange(n_items))), np.concatenate((J, I, np.arange(n_items))))),
+                   shape=(n_items, n_items)).tocsr()
+    norms = np.asarray(X.multiply(X).sum(axis=1)).ravel()
+
+    # every pair in both directions plus the diagonal, sorted by row
+    rows = np.concatenate((I, J, np.arange(n_items))).astype(np.int64)
+    cols = np.concatenate((J, I, np.arange(n_items))).astype(np.int64)
+    order = np.lexsort((cols, rows))
+    rows, cols = rows[order], cols[order]
+    diagonal = np.flatnonzero(rows == cols)
+    starts = np.searchsorted(rows, np.arange(n_items))
+
+    # dot products of the rows of the observed pairs, a block of rows at a time
+    dots = np.empty(len(rows), dtype=np.float64)
+    bounds = np.append(starts, len(rows))
+    for first in range(0, n_items, 4096):
+        last = min(first + 4096, n_items)
+        block = slice(bounds[first], bounds[last])
+        products = X[first:last] @ X.T
+        dots[block] = np.asarray(products[rows[block] - first, cols[block]]).ravel()
+
+    # median of the pairwise sums of the norms, by bisection on the sorted norms
+    sorted_norms = np.sort(norms)
+    low, high = 2 * sorted_norms[0], 2 * sorted_norms[-1]
+    half = n_items * (n_items - 1) / 2
+    for _ in range(64):
+        middle = (low + high) / 2
+        below = np.searchsorted(sorted_norms, middle - sorted_norms, 'right').sum() - np.count_nonzero(2 * sorted_norms <= middle)
+        if below >= half:
+            high = middle
+        else:
+            low = middle
+
+    S = -(norms[rows] + norms[cols] - 2 * dots)
+    S[diagonal] = -high
+
+    # remove degeneracies like sklearn, with a fixed seed
+    S += (np.finfo(np.float64).eps * S + np.finfo(np.float64).tiny * 100) * np.random.default_rng(0).standard_normal(len(S))
+    S = S.astype(np.float32)
+
+    R = np.zeros(len(S), dtype=np.float32)
+    A = np.zeros(len(S), dtype=np.float32)
+    buffer = np.empty(len(S), dtype=np.float32)
+    e = np.zeros((n_items, convergence_iter), dtype=bool)
+
+    for it in range(max_iter):
+        # responsibilities, from the best and second best a + s of every row
+        np.add(A, S, out=buffer)
+        best = np.maximum.reduceat(buffer, starts)
+        found = np.flatnonzero(buffer == best[rows])
+        found = found[np.unique(rows[found], return_index=True)[1]]
+        buffer[found] = -np.inf
+        second = np.maximum.reduceat(buffer, starts)
+        second[np.isneginf(second)] = 0  # items without any observed pair
+
+        np.subtract(S, best[rows], out=buffer)
+        buffer[found] = S[found] - second[rows[found]]
+        buffer *= 1 - damping
+        R *= damping
+        R += buffer
+
+        # availabilities, from the positive responsibilities of every column
+        np.maximum(R, 0, out=buffer)
+        buffer[diagonal] = R[diagonal]
+        totals = np.bincount(cols, weights=buffer, minlength=n_items).astype(np.float32)
+        np.subtract(totals[cols], buffer, out=buffer)
+        self_availability = buffer[diagonal]
+        np.minimum(buffer, 0, out=buffer)
+        buffer[diagonal] = self_availability
+        buffer *= 1 - damping
+        A *= damping
+        A += buffer
+
+        E = (A[diagonal] + R[diagonal]) > 0
+        e[:, it % convergence_iter] = E
+        if it >= convergence_iter:
+            se = np.sum(e, axis=1)
+            unconverged = np.sum((se == convergence_iter) + (se == 0)) != n_items
+            if not unconverged and np.any(E):
+                break
+
+    exemplars = np.flatnonzero(E)
+    if not len(exemplars):
+        return np.full(n_items, -1), exemplars
+
+    # every item joins the exemplar it is most similar to
+    is_exemplar = np.zeros(n_items, dtype=bool)
+    is_exemplar[exemplars] = True
+    candidates = np.flatnonzero(is_exemplar[cols] & ~is_exemplar[rows])
+    candidates = candidates[np.lexsort((-S[candidates], rows[candidates]))]
+    candidates = candidates[np.unique(rows[candidates], return_index=True)[1]]
+
+    assigned = np.arange(n_items)
+    assigned[rows[candidates]] = cols[candidates]
+    exemplars, labels = np.unique(assigned, return_inverse=True)
+
+    return labels, exemplars
+
+def faster_pam(TX, n_clusters, max_iter=100):
+    '''
+    Finds k medoids that minimize the total distance of every
+    item to its nearest medoid, working on the precomputed
+    distances directly.
+
+    The medoids start from the greedy BUILD of PAM, and are then
+    improved with the eager swaps of FasterPAM (Schubert and
+    Rousseeuw, 2021). The nearest and second nearest medoid of
+    every item are cached, so the best swap of one candidate
+    with every medoid at once costs O(N), and the first swap
+    that lowers the total distance is taken.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square timegaps between items.
+
+    n_clusters : int
+        The number of medoids, from 1 to the number of items.
+
+    max_iter : int, default=100
+        Maximum number of passes over the candidates.
+
+    Returns
+    -----------
+    labels : NumPy array (int)
+        Cluster number of each datapoint, which is the position
+        of its nearest medoid in medoids.
+
+    medoids : NumPy array (int)
+        Index of the medoid of every cluster.
+
+    '''
+    n_items = len(TX)
+    if not 1 <= n_clusters <= n_items:
+        raise ValueError(f"Cannot find {n_clusters} medoids among {n_items} items, n_clusters must be from 1 to {n_items}.")
+    if n_clusters == 1:
+        medoids = np.array([np.argmin(TX.sum(axis=1, dtype=np.float64))])
+        return np.zeros(n_items, dtype=np.intp), medoids
+
+    # BUILD, adding the item that lowers the total distance the most
+    medoids = [int(np.argmin(TX.sum(axis=1, dtype=np.float64)))]
+    nearest = TX[medoids[0]].astype(np.float64)
+    gains = np.empty(n_items)
+    for _ in range(n_clusters - 1):
+        for first in range(0, n_items, 1024):
+            gains[first:first + 1024] = np.maximum(nearest - TX[first:first + 1024], 0).sum(axis=1)
+        gains[medoids] = -1
+        medoids.append(int(np.argmax(gains)))
+        np.minimum(nearest, TX[medoids[-1]], out=nearest)
+    medoids = np.array(medoids)
+
+    def assign():
+        DM = TX[:, medoids].astype(np.float64)
+        n1 = np.argmin(DM, axis=1)
+        d1 = DM[np.arange(n_items), n1]
+        DM[np.arange(n_items), n1] = np.inf
+        d2 = DM.min(axis=1)
+        removal = np.bincount(n1, weights=d2 - d1, minlength=n_clusters)
+        return n1, d1, d2, removal
+
+    n1, d1, d2, removal = assign()
+    is_medoid = np.zeros(n_items, dtype=bool)
+    is_medoid[medoids] = True
+
+    # stop after a full pass over the candidates without a swap
+    last_swap = 0
+    for step in range(max_iter * n_items):
+        x = step % n_items
+        if step > 0 and x == last_swap:
+            break
+        if is_medoid[x]:
+            continue
+
+        # change of the total distance when x replaces each medoid
+        dx = TX[x].astype(np.float64)
+        closer = dx < d1
+        second = ~closer & (dx < d2)
+        delta = removal.copy()
+        delta += np.bincount(n1[closer], weights=d1[closer] - d2[closer], minlength=n_clusters)
+        delta += np.bincount(n1[second], weights=dx[second] - d2[second], minlength=n_clusters)
+
+        i = np.argmin(delta)
+        if delta[i] + np.sum(dx[closer] - d1[closer]) < -1e-9:
+            is_medoid[medoids[i]] = False
+            is_medoid[x] = True
+            medoids[i] = x
+            n1, d1, d2, removal = assign()
+            last_swap = x
+
+    return n1, medoids
+
+def cluster_gaps(labels, TX, n_clusters, default_timegap=10000):
+    '''
+    Finds the average timegap between every two clusters,
+    ignoring pairs of items that were never observed.
+
+    All clusters are summed at once with a one-hot label matrix
+    Y, as Y.T @ TX @ Y over the observed timegaps, instead of
+    slicing TX once for every pair of clusters.
+
+    Parameters
+    -----------
+    labels : NumPy array (int)
+        Cluster number of each datapoint.
+
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+        Missing entries of a sparse matrix are never observed.
+
+    n_clusters : int
+        The number of clusters.
+
+    default_timegap : float, default=10000
+        Timegap of pairs that were never observed.
+
+    Returns
+    -----------
+    CX : NumPy array
+        The k x k matrix of average timegaps between clusters.
+        The diagonal is 0, and clusters without any observed
+        pair between them are np.inf.
+
+    CD : ClusterGapView (tuple, float)
+        Key is pair of cluster numbers while value is the
+        average distance between the two clusters. This is a
+        read-only dictionary view of CX.
+
+    '''
+    labels = np.asarray(labels)
+
+    if issparse(TX) or TX.ndim == 1:
+        # only the observed pairs are converted to item ids
+        I, J, values, _ = observed_pairs(TX, default_timegap)
+
+        # each observed pair is summed into its block of clusters,
+        # which is Y.T @ TX @ Y restricted to the upper triangle
+        blocks = (labels[I], labels[J])
+        sums = coo_matrix((values.astype(np.float64), blocks), shape=(n_clusters, n_clusters)).toarray()
+        counts = coo_matrix((np.ones(len(values)), blocks), shape=(n_clusters, n_clusters)).toarray()
+        sums += sums.T
+        counts += counts.T
+    else:
+        Y = coo_matrix((np.ones(len(labels)), (np.arange(len(labels)), labels)), shape=(len(labels), n_clusters)).tocsr()
+        valid = TX != default_timegap
+        sums = np.asarray((Y.T @ np.where(valid, TX.astype(np.float64), 0.0)) @ Y)
+        counts = np.asarray((Y.T @ valid.astype(np.float64)) @ Y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        CX = np.where(counts > 0, sums / counts, np.inf)
+    np.fill_diagonal(CX, 0)
+
+    return CX, ClusterGapView(CX)
+
 ########################################################
 # Clustering
 
-def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters=int):
+def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters=int, n_neighbors=0):
     '''
     Initializes dictionary of timegaps with default values.
 
@@ -283,7 +1288,11 @@ def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters
     TX : distance matrix (NumPy array)
         The rows [i] and columns [j] represent a list of items,
         thus, n_elements = n_features. Value at [i][j] represents
-        timegaps between items.
+        timegaps between items. A condensed matrix is clustered
+        with scipy directly, without expanding it to square. A
+        sparse matrix is clustered with sparse_average_linkage.
+        The linkage tree is cached by linkage_tree, so changing
+        only the threshold or the number of clusters is cheap.
 
     distance_threshold : int, default=None
         The linkage distance threshold at or above which
@@ -295,15 +1304,24 @@ def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters
         ``distance_threshold=None``, it will be equal to 
         the given ``n_clusters``.
 
+    n_neighbors : int, default=0
+        If not 0, the items are only merged along a sparse
+        k-nearest-neighbour graph of the observed timegaps, so
+        memory and time grow with N * n_neighbors. Pairs left
+        out of the graph count as default_timegap in the
+        averages. For large catalogs, TX should then be the
+        sparse matrix of table_to_sparse.
+
     Returns
     -----------
     TC : dictionary (int, list)
         Key is cluster number while value is list of items 
         inside that cluster.
     
-    CD : dictionary (int, list)
+    CD : ClusterGapView (tuple, float)
         Key is pair of cluster numbers while value is the
-        average distance between the two clusters.
+        average distance between the two clusters. The k x k
+        matrix of the distances is CD.matrix.
 
     n_clusters_ : int
         The number of clusters found by the algorithm. If
@@ -317,16 +1335,9 @@ def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters
     if n_clusters == 0:
         n_clusters = None
     
-    agglo = AgglomerativeClustering(n_clusters=n_clusters, 
-                                    metric='precomputed', 
-                                    linkage='average', 
-                                    distance_threshold=distance_threshold
-                                    )
-    agglo.fit(TX)
-    labels = agglo.labels_
-    n_clusters = agglo.n_clusters_
+    Z = linkage_tree(TX, n_neighbors=n_neighbors)
+    labels, n_clusters = cut_linkage(Z, distance_threshold, n_clusters)
     TC = {}
-    CD = {}
 
     for i in range(n_clusters):
         TC[i] = []
@@ -334,22 +1345,7 @@ def agglomerative_clustering(L=list, TX=list, distance_threshold=int, n_clusters
     for item, label in zip(L, labels):
         TC[label].append(item)  
 
-
-    # Cluster gaps
-    for i in range(n_clusters):
-        for j in range(i+1, n_clusters):
-            indices_i = labels == i
-            indices_j = labels == j
-            timegaps_ij = TX[indices_i][:, indices_j]
-
-            # Filter out pairs with timegap equal to 10000
-            valid_indices = timegaps_ij != 10000
-            if valid_indices.any():
-                distance_ij = timegaps_ij[valid_indices].mean()
-                CD[(i, j)] = distance_ij
-                CD[(j, i)] = distance_ij  # Assuming distance is symmetric
-
-    CD = {k: CD[k] for k in sorted(CD.keys(), key=lambda x: (x[0], x[1]))}
+    CX, CD = cluster_gaps(labels, TX, n_clusters)
 
     return TC, CD, n_clusters
 
@@ -366,7 +1362,10 @@ def affinity_propagation_clustering(L=list, TX=list, damping=float, max_iter=int
     TX : distance matrix (NumPy array)
         The rows [i] and columns [j] represent a list of items,
         thus, n_elements = n_features. Value at [i][j] represents
-        timegaps between items.
+        timegaps between items. May also be condensed or sparse.
+        A sparse matrix is clustered with
+        sparse_affinity_propagation, which only passes messages
+        along the observed pairs.
 
     damping : float, default=0.5
         Damping factor (between 0.5 and 1) is the extent to which the
@@ -385,23 +1384,26 @@ def affinity_propagation_clustering(L=list, TX=list, damping=float, max_iter=int
         Key is cluster number while value is list of items 
         inside that cluster.
     
-    CD : dictionary (int, list)
+    CD : ClusterGapView (tuple, float)
         Key is pair of cluster numbers while value is the
-        average distance between the two clusters.
+        average distance between the two clusters. The k x k
+        matrix of the distances is CD.matrix.
 
     n_clusters_ : int
         The number of clusters found by the algorithm.
 
     '''
 
-    SX = distance_to_similarity_matrix(TX) # convert distance matrix to similarity matrix
+    if issparse(TX):
+        labels, exemplars = sparse_affinity_propagation(TX, damping, max_iter, convergence_iter)
+    else:
+        SX = distance_to_similarity_matrix(TX) # convert distance matrix to similarity matrix
 
-    affinity_propagation = AffinityPropagation(damping=damping, max_iter=max_iter, convergence_iter=convergence_iter)
-    affinity_propagation.fit(SX)
-    labels = affinity_propagation.labels_
+        affinity_propagation = AffinityPropagation(damping=damping, max_iter=max_iter, convergence_iter=convergence_iter)
+        affinity_propagation.fit(SX)
+        labels = affinity_propagation.labels_
     n_clusters = len(set(labels))
     TC = {}
-    CD = {}
 
     for i in range(n_clusters):
         TC[i] = []
@@ -409,26 +1411,12 @@ def affinity_propagation_clustering(L=list, TX=list, damping=float, max_iter=int
     for item, label in zip(L, labels):
         TC[label].append(item)  
 
-    # Cluster gaps
-    for i in range(n_clusters):
-        for j in range(i+1, n_clusters):
-            indices_i = labels == i
-            indices_j = labels == j
-            timegaps_ij = TX[indices_i][:, indices_j]
-
-            # Filter out pairs with timegap equal to 10000
-            valid_indices = timegaps_ij != 10000
-            if valid_indices.any():
-                distance_ij = timegaps_ij[valid_indices].mean()
-                CD[(i, j)] = distance_ij
-                CD[(j, i)] = distance_ij  # Assuming distance is symmetric
-
-    CD = {k: CD[k] for k in sorted(CD.keys(), key=lambda x: (x[0], x[1]))}
+    CX, CD = cluster_gaps(labels, TX, n_clusters)
 
     return TC, CD, n_clusters
 
 
-def kmeans_clustering(L=list, TX=list, n_clusters=int):
+def kmeans_clustering(L=list, TX=list, n_clusters=int, n_components=0, method='svd'):
     '''
     Initializes dictionary of timegaps with default values.
 
@@ -440,7 +1428,20 @@ def kmeans_clustering(L=list, TX=list, n_clusters=int):
     TX : distance matrix (NumPy array)
         The rows [i] and columns [j] represent a list of items,
         thus, n_elements = n_features. Value at [i][j] represents
-        timegaps between items.
+        timegaps between items. A condensed or sparse matrix is
+        expanded, since the rows of the matrix are the features.
+
+    n_clusters : int
+        The number of clusters set by the user.
+
+    n_components : int, default=0
+        If not 0, the items are first embedded in this many
+        dimensions with embed_timegaps, and K-Means runs on the
+        embedding instead of the N columns of TX. Catalogs of
+        more than 10000 items then use MiniBatchKMeans.
+
+    method : {'svd', 'mds'}, default='svd'
+        The embedding method of embed_timegaps.
 
     Returns
     -----------
@@ -452,8 +1453,17 @@ def kmeans_clustering(L=list, TX=list, n_clusters=int):
         The number of clusters set by the user.
 
     '''
-
-    kmeans = KMeans(n_clusters=n_clusters, n_init=10)
+    if n_components:
+        TX = embed_timegaps(TX, n_components, method)
+    elif issparse(TX):
+        TX = sparse_to_matrix(TX)
+    elif TX.ndim == 1:
+        TX = squareform(TX, checks=False)
+
+    if n_components and len(TX) > 10000:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, n_init=3, batch_size=4096)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, n_init=10)
     kmeans.fit(TX)
     labels = kmeans.labels_
     TC = {}
@@ -466,6 +1476,62 @@ def kmeans_clustering(L=list, TX=list, n_clusters=int):
 
     return TC, n_clusters
 
+def kmedoids_clustering(L=list, TX=list, n_clusters=int):
+    '''
+    Clusters the items around k medoids with faster_pam, on the
+    precomputed timegaps instead of treating the rows of the
+    matrix as feature vectors.
+
+    Parameters
+    -----------
+    L : list
+        List of items that act as datapoints.
+
+    TX : distance matrix (NumPy array)
+        The rows [i] and columns [j] represent a list of items,
+        thus, n_elements = n_features. Value at [i][j] represents
+        timegaps between items. A condensed or sparse matrix is
+        expanded to square.
+
+    n_clusters : int
+        The number of clusters set by the user, from 1 to the
+        number of items.
+
+    Returns
+    -----------
+    TC : dictionary (int, list)
+        Key is cluster number while value is list of items 
+        inside that cluster.
+    
+    CD : ClusterGapView (tuple, float)
+        Key is pair of cluster numbers while value is the
+        average distance between the two clusters. The k x k
+        matrix of the distances is CD.matrix.
+
+    n_clusters_ : int
+        The number of clusters set by the user.
+
+    '''
+    if issparse(TX):
+        DX = sparse_to_matrix(TX)
+    elif TX.ndim == 1:
+        DX = squareform(TX, checks=False)
+    else:
+        DX = TX
+
+    labels, medoids = faster_pam(DX, n_clusters)
+    TC = {}
+
+    for i in range(n_clusters):
+        TC[i] = []
+
+    for item, label in zip(L, labels):
+        TC[label].append(item)
+
+    CX, CD = cluster_gaps(labels, TX, n_clusters)
+
+    return TC, CD, n_clusters
+
 
 ########################################################
 # Search and Sorting
@@ -550,3 +1616,186 @@ def search_item_cluster(X=str, TC=dict):
         else:
             if value == X:
                 return key
+
+class SortModel:
+    '''
+    Clusters compiled once for sorting many shopping lists.
+
+    Items are mapped to cluster numbers through an array indexed
+    by item id, and the order of the clusters seen from every
+    anchor cluster is precomputed as a rank table, so sorting a
+    list is one integer argsort over the ranks of its items. The
+    cost only depends on the length of the list.
+
+    Items that are in no cluster share an extra cluster number
+    k, which is never near any other cluster.
+
+    Attributes
+    -----------
+    index : dictionary (string, int)
+        Key is an item while value is its id.
+
+    clusters : NumPy array (int)
+        Cluster number of each item id. The last entry is k and
+        is given to unknown items, which are encoded as -1.
+
+    CX : NumPy array
+        The k x k matrix of average timegaps between clusters,
+        np.inf where there is none.
+
+    rank : NumPy array (int)
+        Row a holds the position of every cluster when a list is
+        sorted relative to anchor cluster a. The anchor itself
+        is 0, and clusters with equal timegaps share a rank so
+        their items keep the order of the list.
+
+    '''
+    def __init__(self, TC=dict, CD=dict, index=None):
+        self.empty = not CD and not TC
+        n_clusters = max(TC) + 1 if TC else 0
+
+        members = {}
+        for key, value in TC.items():
+            for item in (value if isinstance(value, list) else [value]):
+                members.setdefault(item, key)
+
+        if index is None:
+            index = {item: i for i, item in enumerate(sorted(members))}
+        self.index = index
+
+        self.clusters = np.full(len(index) + 1, n_clusters, dtype=np.int32)
+        for item, key in members.items():
+            if item in index:
+                self.clusters[index[item]] = key
+
+        if hasattr(CD, 'matrix'):
+            CX = np.array(CD.matrix, dtype=np.float64)
+        else:
+            CX = np.full((n_clusters, n_clusters), np.inf)
+            for (i, j), value in CD.items():
+                if 0 <= i < n_clusters and 0 <= j < n_clusters:
+                    CX[i, j] = value
+        self.CX = CX
+
+        # sort keys of every cluster seen from every anchor, with the
+        # unclustered items as cluster k at np.inf from everything
+        m = min(len(CX), n_clusters)
+        R = np.full((n_clusters + 1, n_clusters + 1), np.inf)
+        R[:m, :m] = CX[:m, :m]
+        np.fill_diagonal(R, -np.inf)
+
+        order = np.argsort(R, axis=1, kind='stable')
+        S = np.take_along_axis(R, order, axis=1)
+        new = np.ones(S.shape, dtype=np.int32)
+        new[:, 1:] = S[:, 1:] != S[:, :-1]
+
+        self.rank = np.empty(R.shape, dtype=np.int32)
+        np.put_along_axis(self.rank, order, np.cumsum(new, axis=1, dtype=np.int32) - 1, axis=1)
+
+    def encode(self, X):
+        '''
+        Converts items to ids. Unknown items are given -1.
+        '''
+        index = self.index
+        return np.array([index.get(item, -1) for item in X], dtype=np.int64)
+
+    def encode_lists(self, SLs):
+        '''
+        Converts a batch of lists to the flat item ids and offsets
+        taken by sort_shopping_lists.
+        '''
+        lengths = np.array([len(SL) for SL in SLs], dtype=np.int64)
+        offsets = np.zeros(len(SLs) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        return self.encode([item for SL in SLs for item in SL]), offsets
+
+    def cluster_of(self, X):
+        '''
+        Returns the cluster number of each item in X, with k
+        for items in no cluster.
+        '''
+        return self.clusters[self.encode(X)]
+
+    def sort(self, X=None, SL=list):
+        '''
+        Sorts a list of items like sort_shopping_list, using the
+        compiled clusters.
+
+        Parameters
+        -----------
+        X : str or None, optional
+            Item being acquired. If X is None, the list is sorted
+            relative to its first item.
+
+        SL : list
+            List of items to be sorted.
+
+        Returns
+        -----------
+        SL : list
+            List of sorted items.
+
+        '''
+        if self.empty:
+            return sorted(SL, key=lambda x: SL.index(x))
+        if not SL:
+            return list(SL)
+
+        if X is None:
+            X = SL[0]
+
+        anchor = self.cluster_of([X])[0]
+        order = np.argsort(self.rank[anchor][self.cluster_of(SL)], kind='stable')
+
+        return [SL[i] for i in order]
+
+def sort_shopping_lists(ids, offsets, SM=SortModel, anchors=None):
+    '''
+    Sorts a batch of shopping lists at once with a compiled sort
+    model. Gives the same orders as sorting every list with
+    SortModel.sort, but with a single lexsort over the list
+    number and the rank of the cluster of every item.
+
+    Parameters
+    -----------
+    ids : NumPy array (int)
+        Item ids of every list one after the other, from
+        SortModel.encode_lists. Unknown items are -1.
+
+    offsets : NumPy array (int)
+        List i is ids[offsets[i]:offsets[i+1]].
+
+    SM : SortModel
+        The compiled clusters.
+
+    anchors : NumPy array (int), default=None
+        Item id of the item being acquired for every list. If
+        anchors is None, every list is sorted relative to its
+        first item.
+
+    Returns
+    -----------
+    order : NumPy array (int)
+        Positions in ids of the sorted items. Every list keeps
+        its place in the batch, so list i is sorted as
+        ids[order[offsets[i]:offsets[i+1]]].
+
+    '''
+    ids = np.asarray(ids, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    list_id = np.repeat(np.arange(len(lengths)), lengths)
+
+    if SM.empty or not len(ids):
+        return np.arange(len(ids))
+
+    if anchors is None:
+        anchors = ids[np.minimum(offsets[:-1], len(ids) - 1)]
+    anchors = SM.clusters[np.asarray(anchors, dtype=np.int64)]
+
+    # the rank already puts the anchor cluster first and the other
+    # clusters by their gap to it, and lexsort keeps ties in order
+    rank = SM.rank[anchors[list_id], SM.clusters[ids]]
+
+    return np.lexsort((rank, list_id))
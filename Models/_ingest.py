@@ -0,0 +1,599 @@
+"""
+Recording Ingestion // dprosa
+
+These routines read the CSV recordings of shopping lists into
+the observations of a pair table. Every recording is an
+independent set of shopping lists, so recordings are read in
+parallel worker processes and their observations are merged
+afterwards.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import io
+import json
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+import numpy as np
+import pandas as pd
+
+from Models._dprosa import extract_timegaps, good_status_mask
+from Models._pairs import PairTable, pair_index
+
+########################################################
+# Partial Timegaps
+
+class PartialTimegaps:
+    '''
+    The timegap observations of some recordings, in the order
+    the recordings were made, before they are added to a pair
+    table.
+
+    The refresh rule of the pair tables depends on the order of
+    the observations of a pair, so partials keep the observations
+    themselves instead of sums that would lose that order.
+    Merging partials is associative, so the recordings can be
+    merged in any grouping as long as their order is kept.
+
+    Attributes
+    -----------
+    items : NumPy array
+        Sorted unique items of all rows with good status.
+
+    I, J : NumPy array (int)
+        Index in items of the two items of each observed pair,
+        where I < J.
+
+    D : NumPy array (float)
+        Timegap of each observation.
+
+    K : NumPy array (int)
+        Index of the list of each observation, counting from
+        the first list of the partial.
+
+    n_lists : int
+        The total number of lists.
+
+    n_rows : int
+        The total number of rows read, good or not.
+
+    '''
+    def __init__(self, items=None, I=None, J=None, D=None, K=None, n_lists=0, n_rows=0):
+        self.items = np.array([], dtype=object) if items is None else items
+        self.I = np.zeros(0, dtype=np.int64) if I is None else I
+        self.J = np.zeros(0, dtype=np.int64) if J is None else J
+        self.D = np.zeros(0, dtype=np.float64) if D is None else D
+        self.K = np.zeros(0, dtype=np.int64) if K is None else K
+        self.n_lists = n_lists
+        self.n_rows = n_rows
+
+    def merge(self, other):
+        '''
+        Returns the observations of this partial followed by
+        those of a later one, over the union of their items.
+        '''
+        return merge_partials([self, other])
+
+    def add_to_table(self, PT=PairTable, timestamp=None):
+        '''
+        Adds the observations to a pair table, like
+        add_timegap_table. Pairs with items outside of the
+        vocabulary of the table are skipped.
+
+        Parameters
+        -----------
+        PT : PairTable
+            Timegaps and thresholds of every pair of items.
+
+        timestamp : float, default=None
+            Wall-clock time of the lists, for a table whose
+            half-life is in seconds. By default every list is
+            timed by its shopper index.
+
+        Returns
+        -----------
+        PT : PairTable
+            Timegaps and thresholds of every pair of items.
+
+        n_lists : int
+            The total number of lists.
+
+        '''
+        ids = PT.encode(self.items)
+        I, J = ids[self.I], ids[self.J]
+        known = (I >= 0) & (J >= 0)
+        T = PT.n_lists + self.K[known] if timestamp is None else timestamp
+        PT.add_timegaps(pair_index(I[known], J[known], PT.n_items), self.D[known], T)
+        PT.n_lists += self.n_lists
+
+        return PT, self.n_lists
+
+def merge_partials(partials=list):
+    '''
+    Merges partials in their order at once, which gives the
+    same observations as merging them one after another
+    without copying the observations for every merge.
+
+    Parameters
+    -----------
+    partials : list of PartialTimegaps
+        The partials in the order of their recordings.
+
+    Returns
+    -----------
+    partial : PartialTimegaps
+        The observations of every partial.
+
+    '''
+    if not partials:
+        return PartialTimegaps()
+
+    items = reduce(np.union1d, [partial.items for partial in partials])
+    offsets = np.cumsum([0] + [partial.n_lists for partial in partials])
+
+    # sorted vocabularies keep I < J when mapped into their union
+    I, J, D, K = [], [], [], []
+    for partial, offset in zip(partials, offsets):
+        ids = np.searchsorted(items, partial.items)
+        I.append(ids[partial.I])
+        J.append(ids[partial.J])
+        D.append(partial.D)
+        K.append(partial.K + offset)
+
+    return PartialTimegaps(items, np.concatenate(I), np.concatenate(J), np.concatenate(D), np.concatenate(K),
+                           int(offsets[-1]), sum(partial.n_rows for partial in partials))
+
+########################################################
+# Reading Recordings
+
+# bytes read from a recording at a time
+CHUNK_SIZE = 1 << 20
+
+# version of the column cache of load_recording, raised when its columns change
+CACHE_VERSION = 1
+
+class RecordingReader(io.RawIOBase):
+    '''
+    Binary stream over a CSV recording that leaves out the null
+    bytes written by the devices. The bytes are read and cleaned
+    in chunks, so a recording is never held in memory as a whole
+    and is parsed straight from the file. With a size, only the
+    first size bytes of the recording are read.
+    '''
+    def __init__(self, file_path, chunk_size=CHUNK_SIZE, size=None):
+        self.file = open(file_path, 'rb')
+        self.chunk_size = chunk_size
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        # removing null bytes only shrinks a chunk, so it always fits
+        while True:
+            n_bytes = min(len(buffer), self.chunk_size)
+            if self.remaining is not None:
+                n_bytes = min(n_bytes, self.remaining)
+            chunk = self.file.read(n_bytes) if n_bytes else b''
+            if not chunk:
+                return 0
+            if self.remaining is not None:
+                self.remaining -= len(chunk)
+            chunk = chunk.replace(b'\x00', b'')
+            if chunk:
+                buffer[:len(chunk)] = chunk
+                return len(chunk)
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+def whole_lines_size(file_path):
+    '''
+    Returns the number of bytes of a CSV recording up to the end
+    of its last whole line. The devices end every row with a
+    newline, so a last line without one is still being written.
+    '''
+    with open(file_path, 'rb') as input_csv:
+        end = input_csv.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(end - CHUNK_SIZE, 0)
+            input_csv.seek(start)
+            newline = input_csv.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+
+    return 0
+
+def read_recording(file_path):
+    '''
+    Reads a single CSV recording, removing the null bytes
+    written by the devices.
+
+    Parameters
+    -----------
+    file_path : str
+        Path of the CSV recording.
+
+    Returns
+    -----------
+    df : DataFrame
+        Contains three columns: item, timestamp, status.
+
+    '''
+    with io.BufferedReader(RecordingReader(file_path), CHUNK_SIZE) as input_csv:
+        try:
+            return pd.read_csv(input_csv, header=None, encoding_errors='replace')
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame(columns=[0, 1, 2])
+
+def read_recording_lists(file_path, chunk_size=100000, size=None):
+    '''
+    Reads a CSV recording in chunks of rows, yielding only
+    whole shopping lists. The rows of the list that is still
+    open at the end of a chunk are carried over to the next
+    chunk, so memory stays bounded by the chunk size and the
+    longest list instead of growing with the recording.
+
+    A list ends where the next timestamp is 0, like in
+    add_timegap, so a chunk is cut before its last good row
+    with a timestamp of 0. The chunks then give the same pairs
+    as the whole recording.
+
+    Parameters
+    -----------
+    file_path : str
+        Path of the CSV recording.
+
+    chunk_size : int, default=100000
+        Number of rows parsed at a time.
+
+    size : int, default=None
+        Number of bytes of the recording to read. The whole
+        recording is read by default.
+
+    Yields
+    -----------
+    df : DataFrame
+        Contains three columns: item, timestamp, status. The
+        items are read as strings, and the status is the boolean
+        mask of good rows, taken from the status as parsed.
+
+    '''
+    carry = None
+    with io.BufferedReader(RecordingReader(file_path, size=size), CHUNK_SIZE) as input_csv:
+        try:
+            chunks = pd.read_csv(input_csv, header=None, dtype={0: str}, chunksize=chunk_size, encoding_errors='replace')
+            for chunk in chunks:
+                chunk[2] = good_status_mask(chunk.iloc[:, 2])
+                if carry is not None:
+                    chunk = pd.concat((carry, chunk), ignore_index=True)
+
+                starts = np.flatnonzero((chunk.iloc[:, 1].to_numpy(dtype=float) == 0) & chunk.iloc[:, 2].to_numpy(dtype=bool))
+                cut = starts[-1] if len(starts) else 0
+                carry = chunk.iloc[cut:]
+                if cut > 0:
+                    yield chunk.iloc[:cut]
+        except pd.errors.EmptyDataError:
+            return
+
+    if carry is not None and len(carry):
+        yield carry
+
+def add_recording(PT=PairTable, file_path=str, chunk_size=100000, timestamp=None, size=None):
+    '''
+    Adds the timegaps of a CSV recording to a pair table chunk
+    by chunk, adding new items to its vocabulary as they are
+    read, so a recording larger than memory can be added.
+
+    Parameters
+    -----------
+    PT : PairTable
+        Timegaps and thresholds of every pair of items.
+
+    file_path : str
+        Path of the CSV recording.
+
+    chunk_size : int, default=100000
+        Number of rows parsed at a time.
+
+    timestamp : float, default=None
+        Wall-clock time of the lists, for a table whose
+        half-life is in seconds.
+
+    size : int, default=None
+        Number of bytes of the recording to read. The whole
+        recording is read by default.
+
+    Returns
+    -----------
+    PT : PairTable
+        Timegaps and thresholds of every pair of items.
+
+    n_lists : int
+        The total number of lists.
+
+    n_rows : int
+        The total number of rows read, good or not.
+
+    '''
+    n_lists, n_rows = 0, 0
+    for df in read_recording_lists(file_path, chunk_size, size):
+        partial = partial_timegaps(df)
+        PT.add_items(partial.items.tolist())
+        PT, chunk_lists = partial.add_to_table(PT, timestamp)
+        n_lists += chunk_lists
+        n_rows += partial.n_rows
+
+    return PT, n_lists, n_rows
+
+def read_appended(file_path, offset=0, final=False):
+    '''
+    Reads the shopping lists written to a CSV recording after
+    a byte offset, so that a recording that is still being
+    written can be added as it grows.
+
+    Only whole lines are read, and the last list is left for
+    the next read unless final is set, since its next row may
+    not be written yet. A list ends where the next timestamp is
+    0, like in add_timegap. The offset returned is never inside
+    a line or inside a list that was left, so a pause in the
+    writing of a recording does not cut any of its lists.
+
+    An offset inside a line, or inside a list, is skipped to the
+    next line and then to the next list, since the rest of a list
+    cannot be read without its beginning.
+
+    Parameters
+    -----------
+    file_path : str
+        Path of the CSV recording.
+
+    offset : int, default=0
+        Number of bytes of the recording already read.
+
+    final : Boolean, default=False
+        Reads the last list too, when the recording is known to
+        be complete, e.g. when its device reported it. A recording
+        that only stopped growing may still be written to, so
+        this is not set on a pause alone.
+
+    Returns
+    -----------
+    df : DataFrame
+        Contains three columns: item, timestamp, status. The
+        items are read as strings, and the status is the boolean
+        mask of good rows, taken from the status as parsed.
+
+    offset : int
+        Number of bytes of the recording read so far.
+
+    '''
+    with open(file_path, 'rb') as input_csv:
+        input_csv.seek(max(offset - 1, 0))
+        data = input_csv.read()
+
+    empty = pd.DataFrame({0: pd.Series(dtype=str), 1: pd.Series(dtype=np.float64), 2: pd.Series(dtype=bool)})
+
+    # the byte before the offset ends the previous line, unless the offset is inside a line
+    resync = offset > 0 and data[:1] != b'\n'
+    if offset > 0:
+        data = data[1:]
+    if resync:
+        newline = data.find(b'\n')
+        if newline < 0:
+            return empty, offset
+        offset, data = offset + newline + 1, data[newline + 1:]
+
+    # a last line without a newline is still being written, even in a final read
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].split(b'\n')
+    line_offsets = np.cumsum([0] + [len(line) + 1 for line in lines])
+    lines = [line.replace(b'\x00', b'') for line in lines]
+    kept = [i for i, line in enumerate(lines) if line.strip()]
+
+    if not kept:
+        return empty, offset + end
+
+    df = pd.read_csv(io.BytesIO(b'\n'.join(lines[i] for i in kept)), header=None, dtype={0: str},
+                     encoding_errors='replace')
+    df[2] = good_status_mask(df.iloc[:, 2])
+    starts = np.flatnonzero((df.iloc[:, 1].to_numpy(dtype=float) == 0) & df.iloc[:, 2].to_numpy(dtype=bool))
+
+    # rows before the first list belong to a list that was read before
+    if offset > 0:
+        if len(starts) == 0:
+            return empty, offset + end if final else offset
+        first = starts[0]
+        if first > 0:
+            offset, end = offset + int(line_offsets[kept[first]]), end - int(line_offsets[kept[first]])
+            line_offsets = line_offsets - line_offsets[kept[first]]
+            df, starts = df.iloc[first:].reset_index(drop=True), starts - first
+            kept = kept[first:]
+
+    if final:
+        return df, offset + end
+
+    # keep the last list, which may still grow, for the next read
+    if len(starts) == 0 or starts[-1] == 0:
+        return empty, offset
+
+    cut = starts[-1]
+    return df.iloc[:cut], offset + int(line_offsets[kept[cut]])
+
+def compile_recordings(file_paths=list, output_file=str, sizes=None):
+    '''
+    Writes CSV recordings one after another into a single CSV
+    file without their null bytes, copying them in chunks.
+
+    Parameters
+    -----------
+    file_paths : list
+        Paths of the CSV recordings, in the order they were
+        recorded.
+
+    output_file : str
+        Path of the compiled CSV file.
+
+    sizes : list, default=None
+        Number of bytes of each recording to copy. The whole
+        recordings are copied by default.
+
+    '''
+    sizes = [None] * len(file_paths) if sizes is None else sizes
+    with open(output_file, 'wb') as output_csv:
+        for file_path, size in zip(file_paths, sizes):
+            last = b'\n'
+            with RecordingReader(file_path, size=size) as input_csv:
+                for chunk in iter(lambda: input_csv.read(CHUNK_SIZE), b''):
+                    output_csv.write(chunk)
+                    last = chunk[-1:]
+
+            # the next recording must start on a line of its own
+            if last != b'\n':
+                output_csv.write(b'\n')
+
+def load_recording(file_path, cache=True, size=None):
+    '''
+    Reads a CSV recording with fixed column types into a
+    DataFrame whose item column is categorical and whose status
+    column is already the boolean mask of good rows.
+
+    The columns are cached as .npy files in a directory next
+    to the recording, and are loaded from there while the size
+    and modification time of the recording are unchanged, so
+    importing the same recording again skips parsing it.
+
+    Parameters
+    -----------
+    file_path : str
+        Path of the CSV recording.
+
+    cache : Boolean, default=True
+        Reads and writes the column cache. The recording is
+        still read if the cache cannot be written.
+
+    size : int, default=None
+        Number of bytes of the recording to read. The whole
+        recording is read by default. The cache is only used
+        for whole recordings.
+
+    Returns
+    -----------
+    df : DataFrame
+        Contains three columns: item (categorical), timestamp
+        (float) and status (bool, True for good rows).
+
+    '''
+    cache_path = file_path + '.cache'
+    stat = os.stat(file_path)
+    source = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    cache = cache and (size is None or size >= stat.st_size)
+    size = None if size is None or size >= stat.st_size else size
+
+    if cache:
+        try:
+            with open(os.path.join(cache_path, 'manifest.json')) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest['source'] == source and manifest.get('version') == CACHE_VERSION:
+                columns = {name: np.load(os.path.join(cache_path, f"{name}.npy")) for name in manifest['columns']}
+                return recording_frame(**columns)
+        except (OSError, ValueError, KeyError):
+            pass
+
+    with io.BufferedReader(RecordingReader(file_path, size=size), CHUNK_SIZE) as input_csv:
+        try:
+            df = pd.read_csv(input_csv, header=None, usecols=[0, 1, 2],
+                             dtype={0: str, 1: np.float64}, encoding_errors='replace')
+        except pd.errors.EmptyDataError:
+            df = pd.DataFrame({0: pd.Series(dtype=str), 1: pd.Series(dtype=np.float64), 2: pd.Series(dtype=str)})
+
+    items = df[0].to_numpy(dtype=object)
+    named = ~pd.isna(df[0]).to_numpy()
+    categories, item_codes = np.unique(items[named].astype(str), return_inverse=True)
+    codes = np.full(len(df), -1, dtype=np.int32)
+    codes[named] = item_codes.ravel()
+
+    # the status is classified as parsed, like read_recording, and rows without an item are never good
+    columns = {'categories': categories, 'codes': codes,
+               'timestamp': df[1].to_numpy(dtype=np.float64),
+               'good': good_status_mask(df[2]) & named}
+
+    if cache:
+        try:
+            os.makedirs(cache_path, exist_ok=True)
+            for name, column in columns.items():
+                np.save(os.path.join(cache_path, f"{name}.npy"), column)
+            with open(os.path.join(cache_path, 'manifest.json.tmp'), 'w') as manifest_file:
+                json.dump({'version': CACHE_VERSION, 'source': source, 'columns': list(columns)}, manifest_file)
+            os.replace(os.path.join(cache_path, 'manifest.json.tmp'), os.path.join(cache_path, 'manifest.json'))
+        except OSError:
+            pass
+
+    return recording_frame(**columns)
+
+def recording_frame(categories, codes, timestamp, good):
+    '''
+    Builds the DataFrame of load_recording from its columns.
+    '''
+    return pd.DataFrame({0: pd.Categorical.from_codes(codes, categories.astype(object)),
+                         1: timestamp, 2: good})
+
+def partial_timegaps(df):
+    '''
+    Extracts the observations of a DataFrame of shopping lists
+    as a PartialTimegaps.
+    '''
+    if len(df) == 0:
+        return PartialTimegaps()
+
+    items, I, J, D, n_lists, K = extract_timegaps(df, lists=True)
+    return PartialTimegaps(items, I, J, D, K, n_lists, len(df))
+
+def read_partial(file_path, size=None):
+    '''
+    Reads a single CSV recording as a PartialTimegaps, through
+    the column cache of load_recording.
+    '''
+    return partial_timegaps(load_recording(file_path, size=size))
+
+def read_recordings(file_paths=list, max_workers=None, sizes=None):
+    '''
+    Reads CSV recordings in a pool of processes, each recording
+    into its own PartialTimegaps, and merges them in the order
+    of the recordings.
+
+    Parameters
+    -----------
+    file_paths : list
+        Paths of the CSV recordings, in the order they were
+        recorded.
+
+    max_workers : int, default=None
+        Number of worker processes. Defaults to the number of
+        processors. With 1, the recordings are read in this
+        process.
+
+    sizes : list, default=None
+        Number of bytes of each recording to read. The whole
+        recordings are read by default.
+
+    Returns
+    -----------
+    partial : PartialTimegaps
+        The observations of every recording.
+
+    '''
+    sizes = [None] * len(file_paths) if sizes is None else sizes
+    if max_workers == 1 or len(file_paths) <= 1:
+        partials = [read_partial(file_path, size) for file_path, size in zip(file_paths, sizes)]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            partials = list(pool.map(read_partial, file_paths, sizes))
+
+    return merge_partials(partials)
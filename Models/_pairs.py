@@ -0,0 +1,785 @@
+"""
+Pair Storage // dprosa
+
+These routines map items to integer ids and store the statistics
+of every pair of items in condensed upper-triangle arrays, instead
+of dictionaries keyed by tuples of item names.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+from collections.abc import Mapping
+
+import numpy as np
+
+# rounds of P² updates with fewer pairs than this are folded pair by pair instead
+SCALAR_PAIRS = 16
+
+########################################################
+# Vocabulary and Pair Indexing
+
+def build_vocabulary(L=list):
+    '''
+    Maps each item to an integer id following the sorted
+    order of the items.
+
+    Parameters
+    -----------
+    L : list
+        List of items that act as datapoints.
+
+    Returns
+    -----------
+    items : list
+        Sorted list of unique items, where the position of
+        an item is its id.
+
+    index : dictionary (string, int)
+        Key is an item while value is its id.
+
+    '''
+    items = sorted(set(L))
+    index = {item: i for i, item in enumerate(items)}
+
+    return items, index
+
+def pair_index(I, J, n_items):
+    '''
+    Converts pairs of item ids to positions in a condensed
+    upper-triangle array, following the ordering used by
+    scipy.spatial.distance.squareform.
+
+    Parameters
+    -----------
+    I, J : int or NumPy array (int)
+        Ids of the two items of each pair, in any order.
+        I and J must be different.
+
+    n_items : int
+        Total number of items in the vocabulary.
+
+    Returns
+    -----------
+    P : int or NumPy array (int)
+        The pair id of each pair.
+
+    '''
+    I, J = np.minimum(I, J), np.maximum(I, J)
+    return n_items * I - I * (I + 1) // 2 + (J - I - 1)
+
+def pair_items(P, n_items):
+    '''
+    Converts pair ids back to the ids of their two items.
+
+    Parameters
+    -----------
+    P : int or NumPy array (int)
+        Pair ids in a condensed upper-triangle array.
+
+    n_items : int
+        Total number of items in the vocabulary.
+
+    Returns
+    -----------
+    I, J : NumPy array (int)
+        Ids of the two items of each pair, where I < J.
+
+    '''
+    P = np.asarray(P, dtype=np.int64)
+    root = np.sqrt(4 * n_items * (n_items - 1) - 8 * P - 7)
+    I = (n_items - 2 - np.floor(root / 2 - 0.5)).astype(np.int64)
+    J = P + I + 1 - n_items * (n_items - 1) // 2 + (n_items - I) * (n_items - I - 1) // 2
+
+    return I, J
+
+########################################################
+# Pair Tables
+
+class PairTable:
+    '''
+    Timegaps and thresholds of every pair of items, stored
+    in condensed arrays indexed by pair id.
+
+    Each pair keeps a running mean, a count and its last
+    observed timegap instead of a list of every observation,
+    so memory does not grow with the number of shoppers.
+
+    A sparse table only stores the pairs that were observed,
+    in arrays aligned with the sorted pair ids in pairs, so its
+    memory grows with the observed pairs instead of with the
+    square of the number of items. Every other pair implicitly
+    has the default timegap.
+
+    A table with a half-life also keeps an exponentially decayed
+    mean of every pair, in which an observation counts half as
+    much as one made a half-life later, so that recent shoppers
+    outweigh those from before a store layout changed.
+
+    A table with a quantile also estimates that quantile of the
+    timegaps of every pair, e.g. the median, with the five P²
+    markers of Jain and Chlamtac. A shopper who wanders off only
+    moves the estimate by one rank instead of dragging a mean,
+    and the markers take constant memory per pair.
+
+    Attributes
+    -----------
+    items : list
+        Sorted list of items, where the position of an item
+        is its id.
+
+    index : dictionary (string, int)
+        Key is an item while value is its id.
+
+    default_timegap : float
+        Timegap of pairs that were never observed.
+
+    sparse : Boolean
+        Determines if only the observed pairs are stored.
+
+    pairs : NumPy array (int)
+        Sorted ids of the stored pairs if the table is sparse,
+        otherwise None.
+
+    timegap : NumPy array (float)
+        Running mean timegap of every stored pair since it was
+        last refreshed. Pairs never observed hold the default
+        timegap.
+
+    count : NumPy array (int)
+        Number of observations in the running mean.
+
+    last : NumPy array (float)
+        Last observed timegap, which the next observation is
+        compared with. Starts at the default timegap.
+
+    threshold : NumPy array (int)
+        The number of observations of a pair that strayed from
+        the one before it since the timegap was last refreshed.
+        The timegap is refreshed on the third, which also resets
+        the threshold.
+
+    half_life : float
+        The half-life of the decayed means, in the units of the
+        times given to add_timegaps, or None to not keep them.
+
+    n_lists : int
+        Number of shopping lists added by add_timegap_table,
+        which is the time of the next list when the half-life
+        is counted in shoppers.
+
+    decayed : NumPy array (float)
+        Exponentially decayed mean timegap of every stored pair
+        if there is a half-life. Pairs never observed hold the
+        default timegap.
+
+    weight : NumPy array (float)
+        Decayed number of observations in the decayed mean, as
+        of the time in stamp.
+
+    stamp : NumPy array (float)
+        Time of the latest observation of every stored pair.
+
+    quantile : float
+        The quantile estimated by the markers, between 0 and
+        1, or None to not keep them.
+
+    markers : NumPy array (float)
+        The five P² marker heights of every stored pair if
+        there is a quantile. Until a pair has five observations
+        they are its observations, in the order they came in.
+
+    marker_positions : NumPy array (int)
+        The positions of the five markers among the sorted
+        observations of every pair, counting from 1.
+
+    seen : NumPy array (int)
+        Number of observations in the markers. Unlike count,
+        it is never reset by a refresh.
+
+    '''
+    def __init__(self, L=list, default_timegap=10000, sparse=False, half_life=None, quantile=None):
+        self.items, self.index = build_vocabulary(L)
+        self.n_items = len(self.items)
+        self.n_pairs = self.n_items * (self.n_items - 1) // 2
+        self.default_timegap = default_timegap
+        self.sparse = sparse
+        self.half_life = half_life
+        self.quantile = quantile
+        self.n_lists = 0
+
+        # arrays aligned with the stored pairs, and their value for new pairs
+        self.fill = {'timegap': default_timegap, 'count': 0, 'last': default_timegap, 'threshold': 0}
+        if half_life:
+            self.fill.update({'decayed': default_timegap, 'weight': 0, 'stamp': 0})
+        if quantile:
+            self.fill.update({'markers': default_timegap, 'marker_positions': 0, 'seen': 0})
+
+        n_slots = 0 if sparse else self.n_pairs
+        self.pairs = np.zeros(0, dtype=np.int64) if sparse else None
+        self.timegap = np.full(n_slots, default_timegap, dtype=np.float64)
+        self.count = np.zeros(n_slots, dtype=np.int32)
+        self.last = np.full(n_slots, default_timegap, dtype=np.float64)
+        self.threshold = np.zeros(n_slots, dtype=np.int32)
+        if half_life:
+            self.decayed = np.full(n_slots, default_timegap, dtype=np.float64)
+            self.weight = np.zeros(n_slots, dtype=np.float64)
+            self.stamp = np.zeros(n_slots, dtype=np.float64)
+        if quantile:
+            self.markers = np.full((n_slots, 5), default_timegap, dtype=np.float64)
+            self.marker_positions = np.zeros((n_slots, 5), dtype=np.int32)
+            self.seen = np.zeros(n_slots, dtype=np.int32)
+
+    def add_items(self, L=list):
+        '''
+        Adds new items to the vocabulary, moving the stored
+        pairs to the ids of the larger vocabulary. Only a dense
+        table is reallocated, and only if an item is new.
+
+        Parameters
+        -----------
+        L : list
+            Items that may not be in the vocabulary yet.
+
+        '''
+        items, index = build_vocabulary(self.items + list(L))
+        if len(items) == self.n_items:
+            return
+
+        # merging sorted vocabularies keeps the old ids in order, so
+        # the moved pair ids stay sorted as well
+        ids = np.array([index[item] for item in self.items], dtype=np.int64)
+        n_items = len(items)
+        n_pairs = n_items * (n_items - 1) // 2
+
+        if self.sparse:
+            I, J = pair_items(self.pairs, self.n_items)
+            self.pairs = pair_index(ids[I], ids[J], n_items)
+        else:
+            I, J = pair_items(np.arange(self.n_pairs), self.n_items)
+            P = pair_index(ids[I], ids[J], n_items)
+            for name, fill in self.fill.items():
+                values = getattr(self, name)
+                moved = np.full((n_pairs,) + values.shape[1:], fill, dtype=values.dtype)
+                moved[P] = values
+                setattr(self, name, moved)
+
+        self.items, self.index = items, index
+        self.n_items, self.n_pairs = n_items, n_pairs
+
+    def encode(self, X):
+        '''
+        Converts items to ids. Unknown items are given -1.
+        '''
+        return np.array([self.index.get(item, -1) for item in X], dtype=np.int64)
+
+    def pair_id(self, key1, key2):
+        '''
+        Returns the pair id of two items, raising KeyError if
+        either item is unknown or both are the same item.
+        '''
+        i, j = self.index[key1], self.index[key2]
+        if i == j:
+            raise KeyError((key1, key2))
+        return int(pair_index(i, j, self.n_items))
+
+    def slots(self, P, insert=False):
+        '''
+        Finds the positions of pairs in the arrays of the table.
+
+        Parameters
+        -----------
+        P : NumPy array (int)
+            Pair ids.
+
+        insert : Boolean, default=False
+            Stores the pairs that are missing from a sparse
+            table. Otherwise their position is -1.
+
+        Returns
+        -----------
+        S : NumPy array (int)
+            Position of each pair. Same as P for a dense table.
+
+        '''
+        P = np.asarray(P, dtype=np.int64)
+        if not self.sparse:
+            return P
+
+        if insert:
+            new = np.setdiff1d(P, self.pairs)
+            if len(new):
+                at = np.searchsorted(self.pairs, new)
+                self.pairs = np.insert(self.pairs, at, new)
+                for name, fill in self.fill.items():
+                    setattr(self, name, np.insert(getattr(self, name), at, fill, axis=0))
+
+        S = np.searchsorted(self.pairs, P)
+        found = S < len(self.pairs)
+        found[found] = self.pairs[S[found]] == P[found]
+        return np.where(found, S, -1)
+
+    def observed(self):
+        '''
+        Returns the sorted ids of the pairs that were observed.
+        '''
+        if self.sparse:
+            return self.pairs.copy()
+        return np.flatnonzero(self.count > 0)
+
+    def condensed(self, values=None, fill=None):
+        '''
+        Returns values of the stored pairs as a condensed array
+        of every pair, giving the missing pairs of a sparse table
+        the fill value.
+
+        Parameters
+        -----------
+        values : NumPy array, default=None
+            Array aligned with the stored pairs. Defaults to
+            timegap.
+
+        fill : float, default=None
+            Value of missing pairs. Defaults to the default
+            timegap.
+
+        '''
+        values = self.timegap if values is None else values
+        if not self.sparse:
+            return values
+
+        out = np.full(self.n_pairs, self.default_timegap if fill is None else fill, dtype=values.dtype)
+        out[self.pairs] = values
+        return out
+
+    def add_timegaps(self, P, D, T=None):
+        '''
+        Folds observed timegaps into the running means of their
+        pairs, refreshing the timegap of a pair by the rules of
+        check_timegap. The means are the same as those given by
+        add_timegap followed by normalize_timegaps.
+
+        A refresh in check_timegap replaces the list with the
+        mean of its last three values, but that value is always
+        the one dropped by the pop(0) at the end of add_timegap.
+        A refresh therefore only restarts the running mean, and
+        the last observation is all that is kept of the window.
+
+        An observation strays if it is more than 10 away from
+        the observation before it, which does not depend on the
+        means, so the rule is applied to every pair at once:
+        the observations are grouped by pair in their original
+        order, the strays are counted along each group, and each
+        pair keeps the mean of its observations since its last
+        refresh.
+
+        Parameters
+        -----------
+        P : NumPy array (int)
+            Pair id of each observation.
+
+        D : NumPy array (float)
+            Timegap of each observation.
+
+        T : float or NumPy array (float), default=None
+            Time of each observation, for the decayed means.
+            Defaults to n_lists.
+
+        '''
+        S = self.slots(P, insert=True)
+        if len(S) == 0:
+            return
+
+        if self.half_life:
+            self.add_decayed(S, D, self.n_lists if T is None else T)
+        if self.quantile:
+            self.add_quantiles(S, D)
+
+        # group the observations by slot, keeping their order within a slot
+        order = np.argsort(S, kind='stable')
+        S, D = S[order], np.asarray(D, dtype=np.float64)[order]
+        n = len(S)
+
+        first = np.ones(n, dtype=bool)
+        first[1:] = S[1:] != S[:-1]
+        starts = np.flatnonzero(first)
+        ends = np.append(starts[1:], n) - 1
+        group = np.cumsum(first) - 1
+        slots = S[starts]
+
+        # every observation is compared with the one before it
+        previous = np.empty(n, dtype=np.float64)
+        previous[1:] = D[:-1]
+        previous[starts] = self.last[slots]
+        previous = np.trunc(previous)
+        strays = (D < previous - 10) | (D > previous + 10)
+
+        # a threshold of 3 or more, left by an older table, refreshes on the next stray
+        threshold = np.minimum(self.threshold[slots], 2)
+        hits = np.cumsum(strays)
+        hits -= (hits[starts] - strays[starts])[group]
+        refresh = strays & ((threshold[group] + hits) % 3 == 0)
+
+        # the running mean restarts at the last refresh of each slot
+        positions = np.where(refresh, np.arange(n), -1)
+        restart = np.maximum.reduceat(positions, starts)
+        restarted = restart >= 0
+
+        total = np.cumsum(D)
+        before = np.where(restarted, restart, starts) - 1
+        sums = total[ends] - np.where(before >= 0, total[np.maximum(before, 0)], 0)
+        counts = ends - np.where(restarted, restart, starts) + 1
+
+        kept = np.where(restarted, 0, self.count[slots])
+        means = (self.timegap[slots] * kept + sums) / (kept + counts)
+
+        self.timegap[slots] = means
+        self.count[slots] = kept + counts
+        self.last[slots] = D[ends]
+        total_hits = hits[ends]
+        self.threshold[slots] = np.where(total_hits > 0, (threshold + total_hits) % 3, self.threshold[slots])
+
+    def add_decayed(self, S, D, T):
+        '''
+        Folds observed timegaps into the decayed means of their
+        pairs. An observation v at time t updates a pair as
+
+            w = weight * 0.5 ** ((t - stamp) / half_life)
+            decayed = (decayed * w + v) / (w + 1)
+            weight, stamp = w + 1, t
+
+        which keeps three numbers per pair. The observations of
+        each pair are folded in at once, by decaying them all to
+        the latest time of the pair, which gives the same means.
+
+        Parameters
+        -----------
+        S : NumPy array (int)
+            Position of the pair of each observation.
+
+        D : NumPy array (float)
+            Timegap of each observation.
+
+        T : float or NumPy array (float)
+            Time of each observation.
+
+        '''
+        T = np.broadcast_to(np.asarray(T, dtype=np.float64), np.shape(S))
+        order = np.argsort(S, kind='stable')
+        S, D, T = S[order], np.asarray(D, dtype=np.float64)[order], T[order]
+
+        first = np.ones(len(S), dtype=bool)
+        first[1:] = S[1:] != S[:-1]
+        starts = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        slots = S[starts]
+
+        # decaying to the latest time keeps every factor at most 1
+        latest = np.maximum(np.maximum.reduceat(T, starts), self.stamp[slots])
+        factors = 0.5 ** ((latest[group] - T) / self.half_life)
+        kept = self.weight[slots] * 0.5 ** ((latest - self.stamp[slots]) / self.half_life)
+
+        weight = kept + np.add.reduceat(factors, starts)
+        self.decayed[slots] = (self.decayed[slots] * kept + np.add.reduceat(D * factors, starts)) / weight
+        self.weight[slots] = weight
+        self.stamp[slots] = latest
+
+    def add_quantiles(self, S, D):
+        '''
+        Folds observed timegaps into the P² markers of their
+        pairs.
+
+        The observations of a pair must be folded in one at a
+        time, but those of different pairs are independent, so
+        the observations are taken in rounds: round r updates
+        the markers of every pair with an r-th observation at
+        once. Once fewer than SCALAR_PAIRS pairs are left in a
+        round, the rest of their observations are folded in pair
+        by pair by fold_markers, so that a busy pair does not
+        cost a whole round of array operations per observation.
+        Both give the markers of the P² algorithm exactly.
+
+        Parameters
+        -----------
+        S : NumPy array (int)
+            Position of the pair of each observation.
+
+        D : NumPy array (float)
+            Timegap of each observation.
+
+        '''
+        order = np.argsort(S, kind='stable')
+        S, D = S[order], np.asarray(D, dtype=np.float64)[order]
+
+        first = np.ones(len(S), dtype=bool)
+        first[1:] = S[1:] != S[:-1]
+        starts = np.flatnonzero(first)
+        rank = np.arange(len(S)) - starts[np.cumsum(first) - 1]
+
+        # group the observations by round, each round has one per pair
+        order = np.argsort(rank, kind='stable')
+        bounds = np.searchsorted(rank[order], np.arange(rank.max() + 2))
+
+        r = 0
+        while r < len(bounds) - 1 and bounds[r + 1] - bounds[r] >= SCALAR_PAIRS:
+            rows = order[bounds[r]:bounds[r + 1]]
+            self.update_markers(S[rows], D[rows])
+            r += 1
+
+        # the observations left belong to a few busy pairs, still in their order
+        rest = rank >= r
+        S, D = S[rest], D[rest]
+        first = np.ones(len(S), dtype=bool)
+        first[1:] = S[1:] != S[:-1]
+        bounds = np.append(np.flatnonzero(first), len(S))
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            self.fold_markers(S[start], D[start:end])
+
+    def update_markers(self, S, x):
+        '''
+        Folds one observation into the P² markers of each of the
+        pairs at positions S, which must all be different.
+        '''
+        seen = self.seen[S]
+        self.seen[S] = seen + 1
+
+        # the first five observations are kept as they are
+        filling = seen < 5
+        if filling.any():
+            F, position = S[filling], seen[filling]
+            self.markers[F, position] = x[filling]
+            full = F[position == 4]
+            self.markers[full] = np.sort(self.markers[full], axis=1)
+            self.marker_positions[full] = np.arange(1, 6)
+
+        S, x, seen = S[~filling], x[~filling], seen[~filling] + 1
+        if len(S) == 0:
+            return
+
+        q = self.markers[S].astype(np.float64)
+        n = self.marker_positions[S].astype(np.float64)
+
+        # the cell of the observation, widening the extreme markers
+        q[:, 0] = np.minimum(q[:, 0], x)
+        q[:, 4] = np.maximum(q[:, 4], x)
+        k = (x[:, None] >= q[:, 1:4]).sum(axis=1)
+        n += np.arange(5) > k[:, None]
+
+        p = self.quantile
+        desired = 1 + (seen[:, None] - 1) * np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+        for i in (1, 2, 3):
+            d = desired[:, i] - n[:, i]
+            move = ((d >= 1) & (n[:, i + 1] - n[:, i] > 1)) | ((d <= -1) & (n[:, i - 1] - n[:, i] < -1))
+            if not move.any():
+                continue
+
+            sign = np.where(d >= 0, 1.0, -1.0)
+            below, at, above = n[:, i - 1], n[:, i], n[:, i + 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                parabolic = q[:, i] + sign / (above - below) * (
+                    (at - below + sign) * (q[:, i + 1] - q[:, i]) / (above - at) +
+                    (above - at - sign) * (q[:, i] - q[:, i - 1]) / (at - below))
+
+                # fall back to linear when the parabola leaves the neighbouring markers
+                neighbour = np.where(sign > 0, i + 1, i - 1)
+                rows = np.arange(len(S))
+                linear = q[:, i] + sign * (q[rows, neighbour] - q[:, i]) / (n[rows, neighbour] - at)
+
+            inside = (q[:, i - 1] < parabolic) & (parabolic < q[:, i + 1])
+            q[:, i] = np.where(move, np.where(inside, parabolic, linear), q[:, i])
+            n[:, i] += np.where(move, sign, 0)
+
+        self.markers[S] = q
+        self.marker_positions[S] = n
+
+    def fold_markers(self, s, x):
+        '''
+        Folds observations into the P² markers of the pair at
+        position s one at a time, with the same steps as
+        update_markers.
+        '''
+        p = self.quantile
+        steps = (0, p / 2, p, (1 + p) / 2, 1)
+        seen = int(self.seen[s])
+        q = [float(v) for v in self.markers[s]]
+        n = [float(v) for v in self.marker_positions[s]]
+
+        for v in x.tolist():
+            # the first five observations are kept as they are
+            if seen < 5:
+                q[seen] = v
+                seen += 1
+                if seen == 5:
+                    q.sort()
+                    n = [1.0, 2.0, 3.0, 4.0, 5.0]
+                continue
+            seen += 1
+
+            # the cell of the observation, widening the extreme markers
+            q[0], q[4] = min(q[0], v), max(q[4], v)
+            k = (v >= q[1]) + (v >= q[2]) + (v >= q[3])
+            for i in range(k + 1, 5):
+                n[i] += 1
+
+            for i in (1, 2, 3):
+                d = 1 + (seen - 1) * steps[i] - n[i]
+                if not ((d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1)):
+                    continue
+
+                sign = 1.0 if d >= 0 else -1.0
+                below, at, above = n[i - 1], n[i], n[i + 1]
+                parabolic = q[i] + sign / (above - below) * (
+                    (at - below + sign) * (q[i + 1] - q[i]) / (above - at) +
+                    (above - at - sign) * (q[i] - q[i - 1]) / (at - below))
+
+                # fall back to linear when the parabola leaves the neighbouring markers
+                if q[i - 1] < parabolic < q[i + 1]:
+                    q[i] = parabolic
+                else:
+                    neighbour = i + 1 if sign > 0 else i - 1
+                    q[i] = q[i] + sign * (q[neighbour] - q[i]) / (n[neighbour] - at)
+                n[i] += sign
+
+        self.markers[s] = q
+        self.marker_positions[s] = n
+        self.seen[s] = seen
+
+    def statistic(self, name=None):
+        '''
+        Returns a timegap statistic of every stored pair.
+
+        Parameters
+        -----------
+        name : str, default=None
+            'mean' for the running means, 'decayed' for the
+            decayed means or 'quantile' for the estimated
+            quantiles. Defaults to the quantiles if the table
+            keeps them, then to the decayed means if it keeps
+            them, then to the running means.
+
+        '''
+        if name is None:
+            name = 'quantile' if self.quantile else 'decayed' if self.half_life else 'mean'
+
+        if name == 'mean':
+            return self.timegap
+        elif name == 'decayed':
+            return self.decayed
+        elif name == 'quantile':
+            return self.quantile_timegap()
+        raise ValueError(f"Unknown timegap statistic: {name}")
+
+    def quantile_timegap(self):
+        '''
+        Returns the estimated quantile timegap of every stored
+        pair. Pairs with fewer than five observations take the
+        quantile of their observations, and pairs never observed
+        the default timegap.
+        '''
+        seen = np.minimum(self.seen, 5)
+        estimate = np.asarray(self.markers[:, 2], dtype=np.float64).copy()
+        estimate[seen == 0] = self.default_timegap
+
+        few = np.flatnonzero((seen > 0) & (seen < 5))
+        if len(few):
+            values = np.where(np.arange(5) < seen[few, None], self.markers[few], np.nan)
+            estimate[few] = np.nanquantile(values, self.quantile, axis=1)
+
+        return estimate
+
+    def view(self, values=None, fill=None):
+        '''
+        Returns a read-only dictionary view of the table keyed
+        by sorted tuples of items, like the dictionaries made by
+        initialize_timegap.
+
+        Parameters
+        -----------
+        values : NumPy array, default=None
+            Array aligned with the stored pairs to expose.
+            Defaults to timegap.
+
+        fill : float, default=None
+            Value of pairs missing from a sparse table. Defaults
+            to the default timegap.
+
+        '''
+        values = self.timegap if values is None else values
+        return PairView(self, values, self.default_timegap if fill is None else fill)
+
+
+class ClusterGapView(Mapping):
+    '''
+    Read-only dictionary view of a k x k matrix of timegaps
+    between clusters.
+
+    Keys are tuples of two different cluster numbers. Pairs of
+    clusters without any observed timegap, which are np.inf in
+    the matrix, are left out like in the dictionaries made
+    before the matrix existed.
+
+    '''
+    def __init__(self, CX):
+        self.matrix = CX
+
+    def __getitem__(self, key):
+        try:
+            i, j = key
+            if i == j or i < 0 or j < 0:
+                raise KeyError(key)
+            value = self.matrix[i, j]
+        except (TypeError, ValueError, IndexError):
+            raise KeyError(key)
+
+        if not np.isfinite(value):
+            raise KeyError(key)
+        return value.item()
+
+    def __iter__(self):
+        finite = np.isfinite(self.matrix)
+        np.fill_diagonal(finite, False)
+        for i, j in zip(*np.nonzero(finite)):
+            yield (int(i), int(j))
+
+    def __len__(self):
+        finite = np.isfinite(self.matrix)
+        return int(np.count_nonzero(finite) - np.count_nonzero(np.diag(finite)))
+
+
+class PairView(Mapping):
+    '''
+    Read-only dictionary view of a condensed pair array.
+
+    Keys are tuples of two items in sorted order, matching
+    the keys of the dictionaries made by initialize_timegap,
+    so code written for those dictionaries keeps working.
+
+    '''
+    def __init__(self, PT, values, fill):
+        self.table = PT
+        self.values = values
+        self.fill = fill
+
+    def __getitem__(self, key):
+        try:
+            key1, key2 = key
+            if not key1 < key2:
+                raise KeyError(key)
+            p = self.table.pair_id(key1, key2)
+        except (TypeError, ValueError):
+            raise KeyError(key)
+
+        s = self.table.slots([p])[0]
+        if s < 0:
+            return self.fill
+        return self.values[s].item()
+
+    def __iter__(self):
+        items = self.table.items
+        for i in range(self.table.n_items):
+            for j in range(i + 1, self.table.n_items):
+                yield (items[i], items[j])
+
+    def __len__(self):
+        return self.table.n_pairs
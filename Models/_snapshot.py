@@ -0,0 +1,251 @@
+"""
+Model Snapshots // dprosa
+
+These routines save the timegaps and clusters of a model as
+raw .npy arrays with a JSON manifest, and load them back as
+memory-mapped arrays, so that a model can be served again
+without reading the recordings or clustering.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import json
+import os
+
+from datetime import datetime
+
+import numpy as np
+
+from Models._dprosa import SortModel
+from Models._pairs import ClusterGapView, PairTable
+
+SNAPSHOT_FORMAT = 'dprosa-snapshot'
+SNAPSHOT_VERSION = 1
+
+########################################################
+# Saving and Loading
+
+def save_snapshot(path, PT=PairTable, TC=None, CD=None, SM=None, total_shoppers=0, metadata=None):
+    '''
+    Saves a model to a snapshot directory. Every array is its own
+    .npy file so it can be memory-mapped, and the manifest is
+    written last, so a directory without one is incomplete.
+
+    Parameters
+    -----------
+    path : str
+        Directory of the snapshot. It is created if needed.
+
+    PT : PairTable
+        The timegaps. The timegaps are stored as float32.
+
+    TC : dictionary (int, list), default=None
+        Key is cluster number while value is list of items
+        inside that cluster.
+
+    CD : ClusterGapView or dictionary (tuple, float), default=None
+        The average timegaps between clusters.
+
+    SM : SortModel, default=None
+        The compiled clusters. Compiled from TC and CD if None.
+
+    total_shoppers : int, default=0
+        The number of shopping lists in the timegaps.
+
+    metadata : dictionary, default=None
+        Extra JSON values to keep in the manifest.
+
+    Returns
+    -----------
+    path : str
+        Directory of the snapshot.
+
+    '''
+    TC = {} if TC is None else TC
+    CD = {} if CD is None else CD
+    if SM is None:
+        SM = SortModel(TC, CD, PT.index)
+    n_clusters = len(SM.CX)
+
+    labels = SM.clusters[:PT.n_items].astype(np.int32)
+    labels[labels == n_clusters] = -1
+
+    arrays = {
+        'items': np.array(PT.items, dtype=str),
+        'timegap': PT.timegap.astype(np.float32),
+        'count': PT.count.astype(np.int32),
+        'last': PT.last.astype(np.float32),
+        'threshold': PT.threshold.astype(np.int32),
+        'labels': labels,
+        'cluster_gaps': SM.CX.astype(np.float32),
+        'rank': SM.rank.astype(np.int32),
+    }
+    if PT.sparse:
+        arrays['pairs'] = PT.pairs
+    if PT.half_life:
+        arrays['decayed'] = PT.decayed.astype(np.float32)
+        arrays['weight'] = PT.weight.astype(np.float32)
+        arrays['stamp'] = PT.stamp
+    if PT.quantile:
+        arrays['markers'] = PT.markers.astype(np.float32)
+        arrays['marker_positions'] = PT.marker_positions.astype(np.int32)
+        arrays['seen'] = PT.seen.astype(np.int32)
+
+    os.makedirs(path, exist_ok=True)
+    manifest = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'n_items': PT.n_items,
+        'n_pairs': PT.n_pairs,
+        'n_clusters': n_clusters,
+        'default_timegap': PT.default_timegap,
+        'sparse': PT.sparse,
+        'half_life': PT.half_life,
+        'quantile': PT.quantile,
+        'n_lists': PT.n_lists,
+        'total_shoppers': int(total_shoppers),
+        'metadata': metadata or {},
+        'arrays': {},
+    }
+
+    for name, array in arrays.items():
+        file_name = f"{name}.npy"
+        np.save(os.path.join(path, file_name), array)
+        manifest['arrays'][name] = {'file': file_name, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+    manifest_path = os.path.join(path, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+    return path
+
+def load_snapshot(path, mmap_mode='c'):
+    '''
+    Opens a snapshot directory, memory-mapping its arrays.
+
+    Parameters
+    -----------
+    path : str
+        Directory of the snapshot.
+
+    mmap_mode : str, default='c'
+        Passed to numpy.load. With 'c', the pages of the arrays
+        are shared until they are written to, and writes are
+        never saved to the snapshot.
+
+    Returns
+    -----------
+    snapshot : Snapshot
+        The arrays and manifest of the snapshot.
+
+    '''
+    with open(os.path.join(path, 'manifest.json')) as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if manifest.get('format') != SNAPSHOT_FORMAT:
+        raise ValueError(f"{path} is not a model snapshot.")
+    if manifest['version'] > SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot version {manifest['version']} is newer than the supported version {SNAPSHOT_VERSION}.")
+
+    arrays = {}
+    for name, spec in manifest['arrays'].items():
+        array = np.load(os.path.join(path, spec['file']), mmap_mode=mmap_mode)
+        if array.dtype.str != spec['dtype'] or list(array.shape) != spec['shape']:
+            raise ValueError(f"Array {name} of {path} does not match its manifest.")
+        arrays[name] = array
+
+    return Snapshot(manifest, arrays)
+
+def latest_snapshot(directory):
+    '''
+    Returns the complete snapshot in a directory with the last
+    name in sorted order, which is the newest for the timestamped
+    names given by the server, or None if there is none.
+    '''
+    if not os.path.isdir(directory):
+        return None
+
+    names = sorted(name for name in os.listdir(directory)
+                   if os.path.exists(os.path.join(directory, name, 'manifest.json')))
+    return os.path.join(directory, names[-1]) if names else None
+
+
+class Snapshot:
+    '''
+    A loaded model snapshot.
+
+    Attributes
+    -----------
+    manifest : dictionary
+        The manifest of the snapshot.
+
+    arrays : dictionary (string, NumPy array)
+        The memory-mapped arrays of the snapshot.
+
+    items : list
+        Sorted list of items, where the position of an item
+        is its id.
+
+    index : dictionary (string, int)
+        Key is an item while value is its id.
+
+    '''
+    def __init__(self, manifest, arrays):
+        self.manifest = manifest
+        self.arrays = arrays
+        self.items = arrays['items'].tolist()
+        self.index = {item: i for i, item in enumerate(self.items)}
+
+    def table(self):
+        '''
+        Returns the timegaps as a PairTable over the mapped
+        arrays, without allocating a new table.
+        '''
+        PT = PairTable([], self.manifest['default_timegap'], self.manifest['sparse'], self.manifest.get('half_life'),
+                       self.manifest.get('quantile'))
+        PT.items, PT.index = list(self.items), dict(self.index)
+        PT.n_items, PT.n_pairs = self.manifest['n_items'], self.manifest['n_pairs']
+        PT.n_lists = self.manifest.get('n_lists', 0)
+        PT.pairs = self.arrays.get('pairs')
+        for name in PT.fill:
+            setattr(PT, name, self.arrays[name])
+
+        return PT
+
+    def clusters(self):
+        '''
+        Returns the clusters as a dictionary of items, like the
+        clustering functions.
+        '''
+        TC = {i: [] for i in range(self.manifest['n_clusters'])}
+        for item, label in zip(self.items, self.arrays['labels'].tolist()):
+            if label >= 0:
+                TC[label].append(item)
+
+        return TC
+
+    def cluster_gaps(self):
+        '''
+        Returns the average timegaps between clusters as a
+        ClusterGapView.
+        '''
+        return ClusterGapView(self.arrays['cluster_gaps'])
+
+    def sort_model(self):
+        '''
+        Returns the compiled clusters as a SortModel over the
+        mapped arrays, without compiling them again.
+        '''
+        n_clusters = self.manifest['n_clusters']
+        labels = self.arrays['labels']
+
+        SM = SortModel({}, {}, self.index)
+        SM.empty = n_clusters == 0
+        SM.clusters = np.append(np.where(labels < 0, n_clusters, labels), n_clusters).astype(np.int32)
+        SM.CX = self.arrays['cluster_gaps']
+        SM.rank = self.arrays['rank']
+
+        return SM
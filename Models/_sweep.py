@@ -0,0 +1,252 @@
+"""
+Clustering Sweeps // dprosa
+
+These routines cluster one timegap matrix with many
+configurations in parallel worker processes, and collect
+the results of every configuration in a table.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from scipy.sparse import csr_matrix, issparse
+from scipy.spatial.distance import squareform
+from sklearn.metrics import silhouette_score
+
+from Models._dprosa import \
+    agglomerative_clustering, kmeans_clustering, kmedoids_clustering, affinity_propagation_clustering, sparse_to_matrix
+
+# state of a worker process, set once by init_worker
+_worker = {}
+
+########################################################
+# Shared Timegap Matrices
+
+def share_matrix(TX):
+    '''
+    Copies a timegap matrix into shared memory, so that worker
+    processes can read it without a copy of their own.
+
+    Parameters
+    -----------
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+
+    Returns
+    -----------
+    blocks : list
+        The SharedMemory blocks holding the matrix. The caller
+        must close and unlink them when the workers are done.
+
+    spec : tuple
+        Picklable description of the blocks, for attach_matrix.
+
+    '''
+    if issparse(TX):
+        TX = TX.tocsr()
+        arrays = (TX.data, TX.indices, TX.indptr)
+    else:
+        arrays = (np.asarray(TX),)
+
+    blocks, layout = [], []
+    for array in arrays:
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        layout.append((block.name, array.dtype.str, array.shape))
+
+    return blocks, (issparse(TX), TX.shape, layout)
+
+def attach_block(name):
+    '''
+    Opens a SharedMemory block made by another process without
+    registering it with the resource tracker. The block belongs
+    to the process that made it, and a registration by a worker
+    would make the tracker warn of a leak and unlink the block
+    again when the worker's tracker shuts down.
+    '''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        pass
+
+    # before Python 3.13 attaching always registers the block, and unregistering it
+    # afterwards would drop the registration of its maker when the tracker is shared
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None if rtype == 'shared_memory' else register(name, rtype)
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+def attach_matrix(spec):
+    '''
+    Opens a timegap matrix shared by share_matrix as read-only
+    arrays over the shared memory.
+
+    Parameters
+    -----------
+    spec : tuple
+        The description returned by share_matrix.
+
+    Returns
+    -----------
+    TX : distance matrix (NumPy array)
+        The shared timegaps.
+
+    blocks : list
+        The attached SharedMemory blocks, which must stay
+        referenced for as long as TX is used.
+
+    '''
+    sparse, shape, layout = spec
+
+    blocks, arrays = [], []
+    for name, dtype, array_shape in layout:
+        block = attach_block(name)
+        array = np.ndarray(array_shape, dtype=dtype, buffer=block.buf)
+        array.flags.writeable = False
+        blocks.append(block)
+        arrays.append(array)
+
+    if sparse:
+        TX = csr_matrix(tuple(arrays), shape=shape, copy=False)
+    else:
+        TX = arrays[0]
+
+    return TX, blocks
+
+########################################################
+# Sweeps
+
+def init_worker(L, spec):
+    '''
+    Attaches a worker process to the shared timegap matrix.
+    '''
+    TX, blocks = attach_matrix(spec)
+    _worker.update(L=L, TX=TX, blocks=blocks, index={item: i for i, item in enumerate(L)}, distances=None)
+
+def square_distances():
+    '''
+    Returns the shared timegaps of a worker as a square matrix
+    for the silhouette, expanding them once per worker.
+    '''
+    if _worker['distances'] is None:
+        TX = _worker['TX']
+        if issparse(TX):
+            _worker['distances'] = sparse_to_matrix(TX)
+        elif TX.ndim == 1:
+            _worker['distances'] = squareform(TX, checks=False)
+        else:
+            _worker['distances'] = TX
+    return _worker['distances']
+
+def run_config(config):
+    '''
+    Clusters the shared timegap matrix with one configuration.
+
+    Parameters
+    -----------
+    config : dictionary
+        'method' is 'AG', 'KM', 'KMD' or 'AP', and every other
+        key is passed to agglomerative_clustering,
+        kmeans_clustering, kmedoids_clustering or
+        affinity_propagation_clustering. The embedding method
+        of kmeans_clustering is given as 'embedding'.
+
+    Returns
+    -----------
+    result : dictionary
+        The configuration, with the number of clusters found
+        as n_clusters_, the sizes of the clusters from largest to smallest, the
+        silhouette on the precomputed timegaps, the wall time
+        of the clustering in seconds, and the error raised by
+        the clustering if any.
+
+    '''
+    L, TX = _worker['L'], _worker['TX']
+    params = {key: value for key, value in config.items() if key != 'method'}
+    result = dict(config, n_clusters_=None, sizes=None, silhouette=np.nan, wall_time=np.nan, error=None)
+
+    wall_time = time.perf_counter()
+    try:
+        if config['method'] == 'AG':
+            TC, CD, n_clusters = agglomerative_clustering(L, TX, params.get('distance_threshold', 0), params.get('n_clusters', 0),
+                                                          params.get('n_neighbors', 0))
+        elif config['method'] == 'KM':
+            TC, n_clusters = kmeans_clustering(L, TX, params['n_clusters'], params.get('n_components', 0), params.get('embedding', 'svd'))
+        elif config['method'] == 'KMD':
+            TC, CD, n_clusters = kmedoids_clustering(L, TX, params['n_clusters'])
+        elif config['method'] == 'AP':
+            TC, CD, n_clusters = affinity_propagation_clustering(L, TX, params.get('damping', 0.9),
+                                                                  params.get('max_iter', 500), params.get('convergence_iter', 15))
+        else:
+            raise ValueError(f"Unknown clustering method: {config['method']}")
+    except Exception as error:
+        result['error'] = repr(error)
+        return result
+    result['wall_time'] = time.perf_counter() - wall_time
+
+    labels = np.empty(len(L), dtype=np.intp)
+    for key, items in TC.items():
+        labels[[_worker['index'][item] for item in items]] = key
+
+    result['n_clusters_'] = n_clusters
+    result['sizes'] = tuple(sorted((len(items) for items in TC.values()), reverse=True))
+    if 2 <= n_clusters <= len(L) - 1:
+        result['silhouette'] = silhouette_score(square_distances(), labels, metric='precomputed')
+
+    return result
+
+def sweep_clustering(L=list, TX=list, configs=list, max_workers=None):
+    '''
+    Clusters one timegap matrix with many configurations over a
+    pool of processes. The matrix is copied once into shared
+    memory and read by every worker, instead of being pickled
+    for every configuration.
+
+    Parameters
+    -----------
+    L : list
+        List of items that act as datapoints.
+
+    TX : distance matrix (NumPy array)
+        Square, condensed or sparse timegaps between items.
+
+    configs : list of dictionaries
+        Configurations to run, as taken by run_config, e.g.
+        {'method': 'AG', 'distance_threshold': 60}.
+
+    max_workers : int, default=None
+        Number of worker processes. Defaults to the number of
+        processors.
+
+    Returns
+    -----------
+    results : pandas DataFrame
+        One row per configuration, in the order of configs,
+        with the parameters of the configurations followed by
+        the results from run_config.
+
+    '''
+    blocks, spec = share_matrix(TX)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker, initargs=(list(L), spec)) as pool:
+            results = list(pool.map(run_config, configs))
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+
+    # parameters first, then the collected results
+    results = pd.DataFrame(results)
+    collected = ['n_clusters_', 'sizes', 'silhouette', 'wall_time', 'error']
+    return results[[column for column in results if column not in collected] + collected]
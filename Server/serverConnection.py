@@ -14,10 +14,15 @@ import threading
 import os
 import sys
 import logging
+import multiprocessing
+import json
+import time
 from datetime import datetime
 
 from concurrent.futures import ThreadPoolExecutor
 from Server.serverDprosa import serverDprosa
+from Models._snapshot import latest_snapshot
+from Models._ingest import read_appended, whole_lines_size
 
 #Global Variables
 MAX_THREADS = 10  # Maximum number of threads in the thread pool
@@ -25,9 +30,12 @@ thread_pool = ThreadPoolExecutor(max_workers=MAX_THREADS)
 
 timegap_dict = {}
 cluster_dict = {}
+sort_model = None
+server_model = None
 global_var_lock = threading.Lock()
+manifest_lock = threading.Lock()
+model_settings = {}
 check_compiled_data = False
-is_sorting = True
 customer_count = 0
 
 global_directory = ''
@@ -36,14 +44,18 @@ global_directory = ''
 '''----------------------------------------------------------------------------------------
 def name:      server
 Description:   This function is used to start the server.
-Params:        None
+Params:        reuse_port - binds with SO_REUSEPORT, so that several processes can listen
+                            on the same port and the kernel spreads the connections
+               actions - the actions served, defaults to ACTION_FUNCTIONS
 Returns:       None
 ----------------------------------------------------------------------------------------'''  
-def server():
+def server(reuse_port=False, actions=None):
     SERVER_ADDRESS = ('localhost', 8080)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     
     try:
+        if reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         server_socket.bind(SERVER_ADDRESS)
         server_socket.listen(10)
         print("Server is listening on", SERVER_ADDRESS)
@@ -56,20 +68,78 @@ def server():
         while True:
             client_socket, client_address = server_socket.accept()
             print("Accepted connection from", client_address)
-            thread_pool.submit(handle_client, client_socket)
+            thread_pool.submit(handle_client, client_socket, actions)
 
 
 '''----------------------------------------------------------------------------------------
 def name:      start_server
 Description:   This function is used to start the server.
-Params:        None
+Params:        snapshot_path - a snapshot, or a directory of snapshots to load the newest
+                               one from, to serve before any clustering is requested
+               watch_interval - if not 0, new recordings are folded into the model every
+                                watch_interval seconds, see start_watcher
+               settings - the settings of every serverDprosa made by the server, e.g.
+                          {'sparse_timegap': True}
 Returns:       None
 ----------------------------------------------------------------------------------------'''      
-def start_server():
+def start_server(snapshot_path=None, watch_interval=0, settings=None):
+    global model_settings
+
+    model_settings = dict(settings or {})
+    if snapshot_path is not None:
+        load_model(snapshot_path)
+
+    if watch_interval:
+        start_watcher(watch_interval)
 
     server_thread = threading.Thread(target=server)
     server_thread.start()
 
+'''----------------------------------------------------------------------------------------
+def name:      start_workers
+Description:   This function is used to serve sorts from several processes instead of the
+               threads of one process, which all share one interpreter lock. The model
+               is published once as a snapshot, which every worker memory-maps read-only,
+               so the workers share its pages instead of each holding a copy. The workers
+               listen on the same port with SO_REUSEPORT and only serve sort and notsort.
+               Every message of a device may reach a different worker, and each worker
+               keeps its own customer count and writes its own sort time file, so the
+               sort times of one session are split across the files of the workers.
+Params:        snapshot_path - a snapshot, or a directory of snapshots to load the newest
+                               one from
+               n_workers - the number of worker processes, defaults to the number of
+                           processors
+Returns:       workers - the started worker processes
+----------------------------------------------------------------------------------------'''      
+def start_workers(snapshot_path, n_workers=None):
+
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise OSError("SO_REUSEPORT is not supported on this platform, use start_server instead.")
+
+    # resolve the snapshot once, so every worker serves the same model
+    if not os.path.exists(os.path.join(snapshot_path, 'manifest.json')):
+        snapshot_path = latest_snapshot(snapshot_path)
+    if snapshot_path is None:
+        raise FileNotFoundError("No snapshot to serve, perform clustering first.")
+
+    workers = []
+    for _ in range(n_workers or os.cpu_count()):
+        worker = multiprocessing.Process(target=sort_worker, args=(snapshot_path,), daemon=True)
+        worker.start()
+        workers.append(worker)
+
+    return workers
+
+'''----------------------------------------------------------------------------------------
+def name:      sort_worker
+Description:   This function is the main function of a worker process of start_workers.
+Params:        snapshot_path - the snapshot to serve
+Returns:       None
+----------------------------------------------------------------------------------------'''      
+def sort_worker(snapshot_path):
+    load_model(snapshot_path, mmap_mode='r')
+    server(reuse_port=True, actions=SORT_ACTIONS)
+
 '''----------------------------------------------------------------------------------------
 def name:       perform_cluster
 Description:    This function is used to perform the clustering of the data.
@@ -89,18 +159,32 @@ def perform_cluster(client_socket,directory):
     global cluster_dict
     global check_compiled_data
     global global_directory
-    sD = serverDprosa()
-
-    if sD.compilereadCSV(directory) == True:
-        check_compiled_data = True
-        sD.cluster_event(directory,int(clusterNo))
-        sD.store_cluster_time_dict(directory)
-        timegap_dict,cluster_dict = sD.timegap_cluster()
-        sD.print_data()
-
-    else :
-        check_compiled_data = False
-        sD.print_data()
+    global server_model
+    global sort_model
+    sD = serverDprosa(model_settings)
+
+    # the watcher waits for the clustering, so it neither folds the recordings in again
+    # nor folds new data into the model that is being replaced
+    with manifest_lock:
+        manifest = mark_recordings(directory)
+        sizes = {csv_file: entry['offset'] for csv_file, entry in manifest.items()}
+
+        if sD.compilereadCSV(directory, sizes) == True:
+            check_compiled_data = True
+            sD.cluster_event(directory,int(clusterNo))
+            sD.store_cluster_time_dict(directory)
+            with global_var_lock:
+                timegap_dict,cluster_dict = sD.timegap_cluster()
+                sort_model = sD.sort_model
+                server_model = sD
+            sD.print_data()
+
+        else :
+            check_compiled_data = False
+            sD.print_data()
+
+        write_manifest(directory, manifest)
+        global_directory = directory
 
     print("Clustering Done..")
     print("*****************************************")
@@ -108,7 +192,276 @@ def perform_cluster(client_socket,directory):
     client_socket.send("DONE.".encode('utf-8'))
     clientID = client_socket
 
-    global_directory = directory
+
+'''----------------------------------------------------------------------------------------
+def name:       load_model
+Description:    This function is used to serve a saved snapshot of the model, which is
+                memory-mapped instead of compiled and clustered again.
+Params:         snapshot_path - a snapshot, or a directory of snapshots to load the newest
+                                one from
+                mmap_mode - 'c' to map the snapshot copy-on-write, so that recordings can
+                            still be added, or 'r' to map it read-only
+Returns:        None
+----------------------------------------------------------------------------------------'''  
+def load_model(snapshot_path, mmap_mode='c'):
+    global timegap_dict
+    global cluster_dict
+    global check_compiled_data
+    global global_directory
+    global server_model
+    global sort_model
+
+    if not os.path.exists(os.path.join(snapshot_path, 'manifest.json')):
+        snapshot_path = latest_snapshot(snapshot_path)
+    if snapshot_path is None:
+        print("No snapshot to load.")
+        return
+
+    sD = serverDprosa(model_settings)
+    directory = sD.loadSnapshot(snapshot_path, mmap_mode)
+
+    with global_var_lock:
+        timegap_dict, cluster_dict = sD.timegap_cluster()
+        sort_model = sD.sort_model
+        server_model = sD
+        check_compiled_data = True
+        global_directory = directory
+
+
+'''----------------------------------------------------------------------------------------
+def name:       perform_update
+Description:    This function is used to fold a new recording into the current model
+                without recompiling every CSV. The clusters are refreshed before the
+                next sort. A recording inside the CSVRecordings folder of the current
+                model is read from its offset in the manifest, which is then moved to its
+                end, so that the watcher does not fold it in a second time. The update
+                also tells that the recording is complete, so its last list is folded in.
+Params:         client_socket - the socket of the client
+                file_path - the path of the new CSV recording
+Returns:        None
+----------------------------------------------------------------------------------------'''  
+def perform_update(client_socket,file_path):
+    global server_model
+
+    file_path = file_path.strip()
+    print(f'Performing update with recording: {file_path}')
+
+    if server_model is None:
+        print("No model to update, perform clustering first.")
+        client_socket.send("NO MODEL.".encode('utf-8'))
+        return
+
+    # a missing or malformed recording is reported to the client instead of ending the thread
+    try:
+        directory = global_directory
+        csvdirectory = os.path.join(directory, 'CSVRecordings') if directory else None
+        if csvdirectory and os.path.dirname(os.path.realpath(file_path)) == os.path.realpath(csvdirectory):
+            with manifest_lock:
+                csv_file = os.path.basename(file_path)
+                manifest = read_manifest(directory)
+                manifest[csv_file] = fold_recording(file_path, manifest.get(csv_file), final=True)[1]
+                write_manifest(directory, manifest)
+        else:
+            df = server_model.readRecording(file_path)
+            with global_var_lock:
+                server_model.addShoppingLists(df)
+    except Exception as e:
+        print("Unable to add recording:", str(e))
+        client_socket.send(f"ERROR: {e}".encode('utf-8'))
+        return
+
+    print("Update Done..")
+    client_socket.send("DONE.".encode('utf-8'))
+
+
+'''----------------------------------------------------------------------------------------
+def name:       start_watcher
+Description:    This function is used to start a background thread that watches the
+                CSVRecordings folder of the current model and folds new recordings, or
+                the bytes appended to recordings, into the model as they arrive.
+Params:         interval - the number of seconds between scans of the folder
+Returns:        watcher_thread - the started thread
+----------------------------------------------------------------------------------------'''  
+def start_watcher(interval=5):
+    watcher_thread = threading.Thread(target=watch_recordings, args=(interval,), daemon=True)
+    watcher_thread.start()
+    return watcher_thread
+
+
+'''----------------------------------------------------------------------------------------
+def name:       watch_recordings
+Description:    This function is the main loop of the watcher thread. The directory is
+                read on every scan, since a clustering may change it.
+Params:         interval - the number of seconds between scans of the folder
+Returns:        None
+----------------------------------------------------------------------------------------'''  
+def watch_recordings(interval):
+    while True:
+        try:
+            if global_directory:
+                scan_recordings(global_directory)
+        except Exception as e:
+            print("Unable to scan recordings:", str(e))
+        time.sleep(interval)
+
+
+'''----------------------------------------------------------------------------------------
+def name:       manifest_path
+Description:    This function is used to get the path of the manifest of the processed
+                recordings, which keeps the size of every recording and the number of its
+                bytes that were folded into the model.
+Params:         directory - the directory of the data
+Returns:        the path of the manifest
+----------------------------------------------------------------------------------------'''  
+def manifest_path(directory):
+    return os.path.join(directory, "Server Data Files", "recordings_manifest.json")
+
+
+'''----------------------------------------------------------------------------------------
+def name:       read_manifest
+Description:    This function is used to read the manifest of the processed recordings.
+Params:         directory - the directory of the data
+Returns:        manifest - the name of every processed recording mapped to its size and
+                           offset
+----------------------------------------------------------------------------------------'''  
+def read_manifest(directory):
+    try:
+        with open(manifest_path(directory)) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+'''----------------------------------------------------------------------------------------
+def name:       write_manifest
+Description:    This function is used to write the manifest of the processed recordings.
+Params:         directory - the directory of the data
+                manifest - the name of every processed recording mapped to its size and
+                           offset
+Returns:        None
+----------------------------------------------------------------------------------------'''  
+def write_manifest(directory, manifest):
+    path = manifest_path(directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+'''----------------------------------------------------------------------------------------
+def name:       list_recordings
+Description:    This function is used to list the CSV recordings and their sizes.
+Params:         directory - the directory of the data
+Returns:        recordings - the name of every CSV recording mapped to its path and size
+----------------------------------------------------------------------------------------'''  
+def list_recordings(directory):
+    csvdirectory = os.path.join(directory, 'CSVRecordings')
+    recordings = {}
+    for csv_file in sorted(f for f in os.listdir(csvdirectory) if f.endswith('.csv')):
+        file_path = os.path.join(csvdirectory, csv_file)
+        recordings[csv_file] = (file_path, os.path.getsize(file_path))
+    return recordings
+
+
+'''----------------------------------------------------------------------------------------
+def name:       mark_recordings
+Description:    This function is used to mark every CSV recording as processed up to the
+                end of its last whole line, before all of them are read by a clustering.
+                The clustering reads the recordings only up to these offsets, so a row that
+                is still being written is left for the watcher.
+Params:         directory - the directory of the data
+Returns:        manifest - the name of every CSV recording mapped to its size and offset,
+                           to be written once the clustering is done
+----------------------------------------------------------------------------------------'''  
+def mark_recordings(directory):
+    return {csv_file: {'offset': whole_lines_size(file_path), 'size': size}
+            for csv_file, (file_path, size) in list_recordings(directory).items()}
+
+
+'''----------------------------------------------------------------------------------------
+def name:       fold_recording
+Description:    This function is used to fold the bytes of a CSV recording after its offset
+                in the manifest into the current model. The manifest_lock must be held, so
+                that the same bytes are not folded in twice.
+Params:         file_path - the path of the CSV recording
+                entry - the size and offset of the recording in the manifest, None if it
+                        was never processed
+                final - whether the recording is complete, so that its last list is folded
+                        in too, see read_appended
+Returns:        n_lists - the number of shopping lists folded in
+                entry - the size and offset of the recording after it was folded in
+----------------------------------------------------------------------------------------'''  
+def fold_recording(file_path, entry=None, final=False):
+    n_lists = 0
+    size = os.path.getsize(file_path)
+
+    entry = dict(entry or {'offset': 0, 'size': 0})
+    # a recording that shrank was replaced, so it is read again
+    if size < entry['offset']:
+        entry = {'offset': 0, 'size': 0}
+
+    if entry['offset'] < size:
+        df, entry['offset'] = read_appended(file_path, entry['offset'], final)
+        if len(df):
+            with global_var_lock:
+                n_lists = server_model.addShoppingLists(df)
+
+    entry['size'] = size
+    return n_lists, entry
+
+
+'''----------------------------------------------------------------------------------------
+def name:       scan_recordings
+Description:    This function is used to fold the CSV recordings that are new or have
+                grown since they were last processed into the current model. Only the
+                bytes after the offset of a recording in the manifest are read, so the cost
+                follows the new data. The last list of a recording is left until the next
+                list starts, or until its device reports the recording with an update,
+                since a recording that stopped growing may only be paused.
+Params:         directory - the directory of the data
+Returns:        n_lists - the number of shopping lists folded in
+----------------------------------------------------------------------------------------'''  
+def scan_recordings(directory):
+    n_lists = 0
+
+    with manifest_lock:
+        if server_model is None:
+            return n_lists
+
+        manifest = read_manifest(directory)
+        for csv_file, (file_path, _) in list_recordings(directory).items():
+            try:
+                file_lists, manifest[csv_file] = fold_recording(file_path, manifest.get(csv_file))
+            except Exception as e:
+                # the other recordings are still folded in
+                print(f"Unable to read recording {csv_file}:", str(e))
+                continue
+            n_lists += file_lists
+
+        write_manifest(directory, manifest)
+
+    if n_lists:
+        print(f"Watcher folded in {n_lists} shopping lists.")
+    return n_lists
+
+
+'''----------------------------------------------------------------------------------------
+def name:       refresh_clusters
+Description:    This function is used to recluster the model if new shopping lists were
+                added since it was last clustered.
+Params:         None
+Returns:        None
+----------------------------------------------------------------------------------------'''  
+def refresh_clusters():
+    global timegap_dict
+    global cluster_dict
+    global sort_model
+
+    with global_var_lock:
+        if server_model is not None and server_model.dirty:
+            server_model.cluster_event(global_directory, server_model.cluster_no)
+            timegap_dict, cluster_dict = server_model.timegap_cluster()
+            sort_model = server_model.sort_model
 
 
 '''----------------------------------------------------------------------------------------
@@ -119,10 +472,7 @@ Params:        client_socket - the socket of the client
 Returns:       None
 ----------------------------------------------------------------------------------------'''  
 def perform_normal(client_socket,data):
-    global is_sorting
-    is_sorting = False
-    perform_sorting(client_socket,data)
-    is_sorting = True
+    perform_sorting(client_socket,data,False)
 
 '''----------------------------------------------------------------------------------------
 def name:      perform_sort
@@ -132,23 +482,22 @@ Params:        client_socket - the socket of the client
 Returns:       None
 ----------------------------------------------------------------------------------------'''  
 def perform_sort(client_socket,data):
-    global is_sorting
-    is_sorting = True
-    perform_sorting(client_socket,data)
-    is_sorting = False
+    perform_sorting(client_socket,data,True)
 
 '''----------------------------------------------------------------------------------------
 def name:      perform_sorting
 Description:   This function is used to perform the sorting of the data.
 Params:        client_socket - the socket of the client
                data - the data to be sorted
+               is_sorting - whether the sorted list is sent back instead of the list as
+                            received. This is passed instead of kept as a global, so that
+                            concurrent clients cannot switch it for each other.
 Returns:       None
 ----------------------------------------------------------------------------------------'''  
-def perform_sorting(client_socket,data):
+def perform_sorting(client_socket,data,is_sorting=True):
     global timegap_dict
     global cluster_dict
     global check_compiled_data
-    global is_sorting
     global customer_count
     # Perform action 2 based on the received data
     print("Performing sorting with list:", data)
@@ -171,6 +520,7 @@ def perform_sorting(client_socket,data):
     else:
         print("Unknown stage description:", stage)
 
+    refresh_clusters()
     sD = serverDprosa()
     itemList = sD.convertData(data)
 
@@ -188,7 +538,7 @@ def perform_sorting(client_socket,data):
 
     if stage == "start":
 
-        sorted_list, timegap_dict, cluster_dict = sD.sort_shoppingList(X, itemList, timegap_dict, cluster_dict, customer_count)
+        sorted_list, timegap_dict, cluster_dict = sD.sort_shoppingList(X, itemList, timegap_dict, cluster_dict, customer_count, sort_model)
         sorted_item = ', '.join(sorted_list)
 
         #add the first item of the itemList into the sorted_item
@@ -197,7 +547,7 @@ def perform_sorting(client_socket,data):
     elif stage == "end":
         sorted_item = ' '.join(itemList)
     else:
-        sorted_list, timegap_dict, cluster_dict = sD.sort_shoppingList(X, itemList, timegap_dict, cluster_dict,  customer_count)
+        sorted_list, timegap_dict, cluster_dict = sD.sort_shoppingList(X, itemList, timegap_dict, cluster_dict,  customer_count, sort_model)
         sorted_item = ', '.join(sorted_list)
         
     print(sorted_item)
@@ -218,9 +568,12 @@ def perform_sorting(client_socket,data):
 def name:      handle_client
 Description:   This function is used to handle the client connection.
 Params:        client_socket - the socket of the client
+               actions - the actions served, defaults to ACTION_FUNCTIONS
 Returns:       None
 ----------------------------------------------------------------------------------------'''  
-def handle_client(client_socket):
+def handle_client(client_socket, actions=None):
+    if actions is None:
+        actions = ACTION_FUNCTIONS
 
     thread_number = threading.get_ident()
     print(f"Thread {thread_number}: Handling client connection.")
@@ -236,9 +589,9 @@ def handle_client(client_socket):
         description = description.strip()
 
         # Check if the description corresponds to a known action
-        if description in ACTION_FUNCTIONS:
+        if description in actions:
             # Call the appropriate function based on the description
-            action_function = ACTION_FUNCTIONS[description]
+            action_function = actions[description]
             action_function(client_socket,data)
             
             break
@@ -289,6 +642,13 @@ class LoggerWriter:
 # Define a mapping of descriptions to functions
 ACTION_FUNCTIONS = {
     "cluster": perform_cluster,
+    "update": perform_update,
+    "sort": perform_sort,
+    "notsort": perform_normal
+}
+
+# The actions of the worker processes, which cannot change the shared model
+SORT_ACTIONS = {
     "sort": perform_sort,
     "notsort": perform_normal
 }
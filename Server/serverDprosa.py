@@ -8,7 +8,6 @@ Revision History:
 ----------------------------------------------------------------------------------------'''
 
 #libraries
-import pandas as pd
 import numpy as np
 #from scipy.cluster.hierarchy import dendrogram, linkage
 #from sklearn.cluster import AgglomerativeClustering
@@ -19,9 +18,11 @@ import json
 from datetime import datetime
 
 from Models._dprosa import \
-    initialize_timegap, add_timegap, check_timegap, normalize_timegaps,\
-    dict_to_matrix, sort_shopping_list, \
-    agglomerative_clustering, kmeans_clustering, affinity_propagation_clustering
+    add_timegap_table, good_status_mask, table_to_matrix, table_to_sparse, sort_shopping_list, \
+    agglomerative_clustering, kmeans_clustering, affinity_propagation_clustering, SortModel
+from Models._pairs import PairTable
+from Models._snapshot import save_snapshot, load_snapshot
+from Models._ingest import read_recording, read_recordings, compile_recordings, add_recording
 
 
 # Global variables
@@ -41,10 +42,11 @@ class serverDprosa():
     '''----------------------------------------------------------------------------------------
     def name:      __init__
     Description:   This function is the constructor of the serverDprosa class.
-    Params:        None
+    Params:        settings - the values of class variables to change, e.g.
+                              {'sparse_timegap': True}
     Returns:       None
     ----------------------------------------------------------------------------------------'''  
-    def __init__(self):
+    def __init__(self, settings=None):
 
         super().__init__()
 
@@ -52,10 +54,19 @@ class serverDprosa():
         self.default_timegap = 10000
         self.item_list = []
         self.total_shoppers = 0
+        self.sparse_timegap = False
+        self.n_neighbors = 0
+        self.half_life = 0
+        self.quantile = 0
+        self.max_workers = None
+        self.compile_csv = False
+        self.chunk_size = 0
+        self.timegap_table = PairTable([], self.default_timegap)
         self.timegap_dict = {}
         self.threshold_dict = {}
         self.cluster_dict = {}
         self.centroid_dict = {}
+        self.sort_model = SortModel({}, {})
         self.timegap_matrix = np.array([])
         self.default_n_clusters = 0
         self.default_distance_threshold = 60
@@ -63,88 +74,158 @@ class serverDprosa():
 
         self.threshold_var = 20
         self.nclusters_var = 0
+        self.cluster_no = 0
+        self.dirty = False
 
         self.sort_time = 0.0
 
+        for name, value in (settings or {}).items():
+            if not hasattr(self, name):
+                raise ValueError(f"Unknown setting: {name}")
+            setattr(self, name, value)
+
     '''----------------------------------------------------------------------------------------
     def name:      compileCSV
-    Description:   This function compiles all the CSV files in the CSVRecordings folder.
+    Description:   This function reads all the CSV files in the CSVRecordings folder. The
+                   recordings are parsed as they are read, and only compiled into a single
+                   CSV file if compile_csv is set.
     Params:        directory - the directory of the CSV files
-    Returns:       True if the file has data, False otherwise
+                   sizes - the name of every CSV file to read mapped to the number of its
+                           bytes to read, by default every CSV file is read whole
+    Returns:       True if the recordings have data, False otherwise
     ----------------------------------------------------------------------------------------'''
-    def compilereadCSV(self, directory):
+    def compilereadCSV(self, directory, sizes=None):
         global sort_directory
         self.start_time = time.time()
 
-        print("Compiling CSV")
         sort_directory = directory
-        # Create a new directory for the compiled CSV files
-        compiled_directory = os.path.join(directory, 'Server Data Files', 'compiled_csv')
-        os.makedirs(compiled_directory, exist_ok=True)
-
-        current_time = time.strftime("%Y%m%d%H%M%S")
-        compiledname = f"CompiledData_{current_time}.csv"
-        output_file = os.path.join(compiled_directory, compiledname)
-
         csvdirectory = os.path.join(directory, 'CSVRecordings')
 
         print(f"Accessing files in folder: {csvdirectory}")
 
-        csv_files = [f for f in os.listdir(csvdirectory) if f.endswith('.csv')]
+        if sizes is None:
+            csv_files = [f for f in os.listdir(csvdirectory) if f.endswith('.csv')]
+        else:
+            csv_files = list(sizes)
         csv_files.sort()
+        file_paths = [os.path.join(csvdirectory, csv_file) for csv_file in csv_files]
+        file_sizes = None if sizes is None else [sizes[csv_file] for csv_file in csv_files]
 
-        # Delete the existing CSV file if it exists
-        if os.path.exists(output_file):
-            os.remove(output_file)
-
-        with open(output_file, 'a', newline='') as output_csv:
-            writer = csv.writer(output_csv)
+        if self.compile_csv:
+            print("Compiling CSV")
+            # Create a new directory for the compiled CSV files
+            compiled_directory = os.path.join(directory, 'Server Data Files', 'compiled_csv')
+            os.makedirs(compiled_directory, exist_ok=True)
 
-            for csv_file in csv_files:
-                file_path = os.path.join(csvdirectory, csv_file)
-                with open(file_path, 'r', errors='replace') as input_csv:
-                    csv_text = input_csv.read().replace('\x00', '')
-                    csv_lines = csv_text.splitlines()
+            current_time = time.strftime("%Y%m%d%H%M%S")
+            compiledname = f"CompiledData_{current_time}.csv"
+            compile_recordings(file_paths, os.path.join(compiled_directory, compiledname), file_sizes)
+            print("Done compiling CSV")
 
-                    reader = csv.reader(csv_lines)
+        if self.chunk_size:
+            return self.getTimegapChunks(file_paths, file_sizes)
 
-                    for row in reader:
-                        writer.writerow(row)
-        print("Done compiling CSV")
+        # each recording is read in its own process, then merged in order
+        partial = read_recordings(file_paths, self.max_workers, file_sizes)
 
-        # Check if the file has data
-        if os.path.getsize(output_file) == 0:
+        # Check if the recordings have data
+        if partial.n_rows == 0:
             print("No data collected yet...")
-            return False  # File has no data
+            return False  # Recordings have no data
         else:
-            df = pd.read_csv(output_file, header=None)
-            self.getTimegapDict(df)
+            self.getTimegapPartial(partial)
 
             return True
         
 
     '''----------------------------------------------------------------------------------------
-    def name:      getTimegapDict
-    Description:   This function gets the timegap dictionary from the CSV file.
-    Params:        df - the dataframe of the CSV file
+    def name:      getTimegapPartial
+    Description:   This function gets the timegap dictionary from the merged observations of
+                   the CSV recordings.
+    Params:        partial - the PartialTimegaps of the CSV recordings
     Returns:       None
     ----------------------------------------------------------------------------------------'''    
-    def getTimegapDict(self,df):
+    def getTimegapPartial(self,partial):
         print("--- %s seconds ---    || AFTER CSV READ" % (time.time() - self.start_time))
 
-        self.item_list = sorted(df[(df.iloc[:, 2].apply(lambda x: isinstance(x, (int, float))) | \
-                                    df.iloc[:, 2].apply(lambda x: str(x).isdigit() or x == 'Good'))].iloc[:, 0].unique())
+        self.item_list = partial.items.tolist()
+        self.timegap_table = PairTable(self.item_list, self.default_timegap, sparse=self.sparse_timegap, half_life=self.half_life or None,
+                                       quantile=self.quantile or None)
+        self.timegap_table, self.total_shoppers = partial.add_to_table(self.timegap_table)
+
+        print("--- %s seconds ---    || AFTER ADD TIMEGAP" % (time.time() - self.start_time))
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
+        print("--- %s seconds ---    || AFTER TIMEGAP DICT" % (time.time() - self.start_time))
 
-        print("--- %s seconds ---    || AFTER SORTING" % (time.time() - self.start_time))
-            
-        self.timegap_dict, self.threshold_dict = initialize_timegap(self.item_list, self.default_timegap)
-        print("--- %s seconds ---    || AFTER INIT TIMEGAP" % (time.time() - self.start_time))
-        self.timegap_dict, self.total_shoppers = add_timegap(df, self.timegap_dict, self.threshold_dict,True)
 
+    '''----------------------------------------------------------------------------------------
+    def name:      getTimegapChunks
+    Description:   This function gets the timegap dictionary from the CSV recordings by
+                   reading them chunk_size rows at a time, so that memory does not grow
+                   with the recordings. New items are added to the timegaps as they are read.
+    Params:        file_paths - the paths of the CSV recordings
+                   file_sizes - the number of bytes to read of every CSV recording, by
+                                default every CSV recording is read whole
+    Returns:       True if the recordings have data, False otherwise
+    ----------------------------------------------------------------------------------------'''    
+    def getTimegapChunks(self,file_paths,file_sizes=None):
+        self.timegap_table = PairTable([], self.default_timegap, sparse=self.sparse_timegap, half_life=self.half_life or None,
+                                       quantile=self.quantile or None)
+        self.total_shoppers = 0
+
+        n_rows = 0
+        file_sizes = [None] * len(file_paths) if file_sizes is None else file_sizes
+        for file_path, file_size in zip(file_paths, file_sizes):
+            self.timegap_table, n_lists, file_rows = add_recording(self.timegap_table, file_path, self.chunk_size,
+                                                                  size=file_size)
+            self.total_shoppers += n_lists
+            n_rows += file_rows
         print("--- %s seconds ---    || AFTER ADD TIMEGAP" % (time.time() - self.start_time))
-        self.timegap_dict = normalize_timegaps(self.timegap_dict)
-        self.timegap_dict = dict(sorted(self.timegap_dict.items(), key=lambda x: x[1]))
+
+        if n_rows == 0:
+            print("No data collected yet...")
+            return False
+
+        self.item_list = self.timegap_table.items
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
         print("--- %s seconds ---    || AFTER TIMEGAP DICT" % (time.time() - self.start_time))
+        return True
+
+    '''----------------------------------------------------------------------------------------
+    def name:      readRecording
+    Description:   Reads a single CSV recording, removing the null bytes written by the devices.
+    Params:        file_path - the path of the CSV recording
+    Returns:       df - the dataframe of the CSV recording
+    ----------------------------------------------------------------------------------------'''
+    def readRecording(self, file_path):
+        return read_recording(file_path)
+
+
+    '''----------------------------------------------------------------------------------------
+    def name:      addShoppingLists
+    Description:   Folds new shopping lists into the current timegap statistics, in time
+                   proportional to the new lists, and marks the clusters as dirty.
+    Params:        df - the dataframe of the new shopping lists
+    Returns:       n_lists - the number of new shopping lists
+    ----------------------------------------------------------------------------------------'''
+    def addShoppingLists(self, df):
+        if len(df) == 0:
+            return 0
+
+        good = good_status_mask(df.iloc[:, 2])
+        self.timegap_table.add_items(df.iloc[:, 0].to_numpy()[good])
+        self.timegap_table, n_lists = add_timegap_table(df, self.timegap_table, True)
+
+        self.item_list = self.timegap_table.items
+        self.total_shoppers += n_lists
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
+        self.dirty = True
+
+        print(f"Added {n_lists} shopping lists, total shoppers: {self.total_shoppers}")
+        return n_lists
 
 
     '''----------------------------------------------------------------------------------------
@@ -171,20 +252,27 @@ class serverDprosa():
     Returns:       None
     ----------------------------------------------------------------------------------------'''    
     def cluster_event(self,directory,clusterNo):
+        self.cluster_no = clusterNo
         clustering_type = "None"
         cluster_time = time.perf_counter()
-        self.timegap_matrix = dict_to_matrix(self.item_list, self.timegap_dict)
+        if self.sparse_timegap:
+            self.timegap_matrix = table_to_sparse(self.timegap_table)
+        else:
+            self.timegap_matrix = table_to_matrix(self.timegap_table, condensed=True)
 
         if(clusterNo == 0 or clusterNo == 1):
             clustering_type = "AG"
             if(clusterNo == 0):
                 clustering_type = "None"
-            self.cluster_dict, self.centroid_dict, self.n_clusters= agglomerative_clustering(self.item_list, self.timegap_matrix, self.threshold_var, self.nclusters_var)
+            self.cluster_dict, self.centroid_dict, self.n_clusters= agglomerative_clustering(self.item_list, self.timegap_matrix, self.threshold_var, self.nclusters_var, self.n_neighbors)
         else:
             clustering_type = "AP"
             self.cluster_dict, self.centroid_dict, self.n_clusters= affinity_propagation_clustering(self.item_list, self.timegap_matrix, 0.9, 500, 15)
 
+        self.sort_model = SortModel(self.cluster_dict, self.centroid_dict, self.timegap_table.index)
+
         cluster_time = time.perf_counter() - cluster_time
+        self.dirty = False
             
         print(f"-------------------------------------")
         print(f"---Cluster Time : {cluster_time}")
@@ -287,17 +375,22 @@ class serverDprosa():
                    shopping_list - the shopping list to be sorted
                    timegap_dict - the dictionary of the timegaps
                    cluster_dict - the dictionary of the clusters
+                   sort_model - the compiled clusters, used instead of the
+                                dictionaries when given
     Returns:       shopping_list - the sorted shopping list
                    timegap_dict - the updated dictionary of the timegaps
                    cluster_dict - the updated dictionary of the clusters  
     ----------------------------------------------------------------------------------------'''    
-    def sort_shoppingList(self,X,shopping_list, timegap_dict, cluster_dict, customerNumber):
+    def sort_shoppingList(self,X,shopping_list, timegap_dict, cluster_dict, customerNumber, sort_model=None):
 
         if X == None:
             # Record start time  
             start_sort = time.perf_counter_ns()
 
-        shopping_list = sort_shopping_list(X, shopping_list, timegap_dict, cluster_dict)
+        if sort_model is not None:
+            shopping_list = sort_model.sort(X, shopping_list)
+        else:
+            shopping_list = sort_shopping_list(X, shopping_list, timegap_dict, cluster_dict)
 
         if X == None:
             # Calculate elapsed time
@@ -327,16 +420,13 @@ class serverDprosa():
 
     '''----------------------------------------------------------------------------------------
     def name:      store_cluster_time_dict
-    Description:   Stores the cluster and timegap dictionaries as JSON files.
+    Description:   Stores the cluster dictionary as a JSON file, and the timegaps and
+                   clusters as a binary snapshot that loadSnapshot can read back.
     Params:        directory - the directory of the CSV files
     Returns:       None
     ----------------------------------------------------------------------------------------'''    
     def store_cluster_time_dict(self, directory):
         clusters_dict = self.cluster_dict
-        timegaps_dict = self.timegap_dict
-
-        # Convert tuple keys to strings in timegaps_dict
-        timegaps_dict_str_keys = {str(key): value for key, value in timegaps_dict.items()}
 
         # Create the child directory "Clusters_and_Timegaps" if it doesn't exist
         child_directory = os.path.join(directory,"Server Data Files", "Clusters_and_Timegaps")
@@ -352,15 +442,45 @@ class serverDprosa():
         with open(clusters_file_path, 'w') as clusters_file:
             json.dump(clusters_dict, clusters_file)
 
-        # Write timegaps dictionary to a file with the same timestamp as suffix
-        timegaps_file_path = os.path.join(child_directory, f"timegaps_{current_time_suffix}.json")
-
-        with open(timegaps_file_path, 'w') as timegaps_file:
-            json.dump(timegaps_dict_str_keys, timegaps_file)
+        # Write the model snapshot with the same timestamp as suffix
+        snapshot_path = os.path.join(directory, "Server Data Files", "Snapshots", f"snapshot_{current_time_suffix}")
+        save_snapshot(snapshot_path, self.timegap_table, self.cluster_dict, self.centroid_dict, self.sort_model,
+                      self.total_shoppers, {'directory': directory, 'cluster_no': self.cluster_no})
 
         # Print the paths for confirmation
         print(f"Clusters file stored at: {clusters_file_path}")
-        print(f"Timegaps file stored at: {timegaps_file_path}")
+        print(f"Snapshot stored at: {snapshot_path}")
+
+    '''----------------------------------------------------------------------------------------
+    def name:      loadSnapshot
+    Description:   Loads the timegaps and clusters of a snapshot, memory-mapping its arrays,
+                   so that sorts can be served without compiling or clustering.
+    Params:        snapshot_path - the directory of the snapshot
+                   mmap_mode - the mode the arrays are memory-mapped with, see load_snapshot
+    Returns:       directory - the directory of the CSV files the snapshot was made from
+    ----------------------------------------------------------------------------------------'''
+    def loadSnapshot(self, snapshot_path, mmap_mode='c'):
+        global sort_directory
+        snapshot = load_snapshot(snapshot_path, mmap_mode)
+        metadata = snapshot.manifest['metadata']
+        sort_directory = metadata.get('directory', '')
+
+        self.timegap_table = snapshot.table()
+        self.sparse_timegap = self.timegap_table.sparse
+        self.item_list = self.timegap_table.items
+        self.total_shoppers = snapshot.manifest['total_shoppers']
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
+
+        self.cluster_dict = snapshot.clusters()
+        self.centroid_dict = snapshot.cluster_gaps()
+        self.sort_model = snapshot.sort_model()
+        self.n_clusters = snapshot.manifest['n_clusters']
+        self.cluster_no = metadata.get('cluster_no', 0)
+        self.dirty = False
+
+        print(f"Loaded snapshot: {snapshot_path}")
+        return metadata.get('directory', '')
 
     '''----------------------------------------------------------------------------------------
     def name:      sort_time_csv
@@ -381,6 +501,9 @@ class serverDprosa():
             sort_suffix_time = datetime.now().strftime("%Y%m%d_%H%M%S")
             sort_time_file = os.path.join(sort_time_directory, f'sort_time_{sort_suffix_time}.csv')
         elif customerNumber > 1:
+            # a worker process may not have seen the first customer
+            if not sort_suffix_time:
+                sort_suffix_time = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}"
             sort_time_file = os.path.join(sort_time_directory, f'sort_time_{sort_suffix_time}.csv')
 
         # Check if the file exists
@@ -7,9 +7,10 @@ Authors: Johnfil Initan, Vince Abella, Jake Perez
 
 """
 
-import pandas as pd
 import numpy as np
+import csv
 import time
+import os
 
 import customtkinter as CTk
 import tkinter as Tk
@@ -18,11 +19,30 @@ from PIL import Image
 
 from Models._dprosa import \
     initialize_timegap, add_timegap, check_timegap, normalize_timegaps,\
-    dict_to_matrix, sort_shopping_list, \
-    agglomerative_clustering, kmeans_clustering, affinity_propagation_clustering
+    add_timegap_table, good_status_mask, dict_to_matrix, table_to_matrix, table_to_sparse, sort_shopping_list, sort_shopping_lists, \
+    agglomerative_clustering, kmeans_clustering, kmedoids_clustering, affinity_propagation_clustering, SortModel
+from Models._pairs import PairTable
+from Models._snapshot import latest_snapshot, load_snapshot
+from Models._ingest import add_recording, load_recording
 
 from Views.PlotView import PlotDataPopup
 
+########################################################
+# rows read at a time when importing, 0 to read whole files
+CHUNK_SIZES = {"Read Whole Files": 0, "Read 100000 Rows at a Time": 100000, "Read 1000000 Rows at a Time": 1000000}
+
+# quantile of the timegaps that the items are clustered on, 0 to cluster on a mean
+QUANTILES = {"Cluster on Mean": 0, "Cluster on Median": 0.5, "Cluster on 75th Percentile": 0.75}
+
+# shoppers after which an observed timegap counts half as much, 0 to weigh every shopper the same
+HALF_LIVES = {"Keep Every Shopper": 0, "Half-Life of 100 Shoppers": 100, "Half-Life of 1000 Shoppers": 1000}
+
+# neighbours of every item that agglomerative clustering merges along, 0 to merge along every pair
+NEIGHBORS = {"Merge Along All Pairs": 0, "Merge Along 10 Nearest": 10, "Merge Along 30 Nearest": 30}
+
+# dimensions of the embedding that K-Means runs on, 0 to run on the timegaps themselves
+EMBEDDINGS = {"K-Means on All Timegaps": 0, "K-Means on 10 Dimensions": 10, "K-Means on 30 Dimensions": 30}
+
 ########################################################
 CTk.set_appearance_mode("system")
 CTk.set_default_color_theme("green")
@@ -49,12 +69,52 @@ class DeepRosaGUI(CTk.CTk):
         This is equivalent to the total number of concatenated
         shopping lists read from a CSV file.
     
+    sparse_timegap : bool
+        Determines if only the observed pairs of items are
+        stored, for catalogs too large for a dense matrix. The
+        timegap_matrix is then a sparse matrix where every
+        missing pair has the default timegap.
+
+    n_neighbors : int
+        If not 0, AgglomerativeClustering only merges items
+        along a graph of the n_neighbors shortest observed
+        timegaps of every item, so that memory and time grow
+        with N * n_neighbors instead of N squared.
+
+    n_components : int
+        If not 0, KMeansClustering runs on an embedding of the
+        items in this many dimensions instead of on the rows of
+        timegap_matrix.
+
+    half_life : int
+        If not 0, timegap_table also keeps a mean of every pair
+        that decays by half every half_life shoppers, and the
+        items are clustered on it instead of on the plain mean,
+        so that the latest store layout dominates.
+
+    quantile : float
+        If not 0, timegap_table also estimates this quantile of
+        the timegaps of every pair, e.g. 0.5 for the median,
+        and the items are clustered on it instead of on a mean,
+        so that a shopper who wanders off does not skew a pair.
+
+    chunk_size : int
+        If not 0, imported files are read this many rows at a
+        time, carrying unfinished shopping lists over to the
+        next chunk, so that memory does not grow with the size
+        of the file.
+
+    timegap_table : PairTable
+        The timegaps and thresholds of every pair of items,
+        stored in condensed arrays indexed by pair id.
+
     timegap_dict : dict
         A dictionary containing pairs of items as keys (thus 
         length of the dictionary is equal to the combination
         of 2 items from a set of N set of items where N is the
         length of item_list), while the values are the timegaps
-        between the two items.
+        between the two items. This is a read-only view of
+        timegap_table.
     
     threshold_dict : dict
         A dictionary containing the same keys in timegap_dict,
@@ -68,7 +128,8 @@ class DeepRosaGUI(CTk.CTk):
     
     timegap_matrix : NumPy array
         A distance matrix used to store the data in timegap_dict
-        but represented in matrix form. This is used as the input
+        but represented in condensed float32 form, i.e. only the
+        upper triangle of the matrix. This is used as the input
         for AgglomerativeClustering, and other possible models
         that can use precomputed distance matrices as inputs. For
         KMeansClustering, this is automatically converted to a
@@ -81,7 +142,8 @@ class DeepRosaGUI(CTk.CTk):
         and stored in a different, adjustable variable via a
         slider. For AgglomerativeClustering, the slider must be
         set to 0 if the distance threshold is not 0. For 
-        KMeansClustering, the slider must not be 0. For 
+        KMeansClustering and K-Medoids, the slider must not
+        be 0. For 
         AffinityPropagation, this does not matter.
     
     default_distance_threshold : int
@@ -98,7 +160,7 @@ class DeepRosaGUI(CTk.CTk):
         grocery shopping experience.
         
     """
-    def __init__(self):
+    def __init__(self, snapshot_path=None, n_components=0):
 
         super().__init__()
 
@@ -110,10 +172,18 @@ class DeepRosaGUI(CTk.CTk):
         self.default_timegap = 10000
         self.item_list = []
         self.total_shoppers = 0
+        self.sparse_timegap = False
+        self.n_neighbors = 0
+        self.n_components = n_components
+        self.half_life = 0
+        self.quantile = 0
+        self.chunk_size = 0
+        self.timegap_table = PairTable([], self.default_timegap)
         self.timegap_dict = {}
         self.threshold_dict = {}
         self.cluster_dict = {}
         self.clustergap_dict = {}
+        self.sort_model = SortModel({}, {})
         self.timegap_matrix = np.array([])
         self.default_n_clusters = 0
         self.default_distance_threshold = 60
@@ -163,15 +233,32 @@ class DeepRosaGUI(CTk.CTk):
             
         self.agglo_cluster_radio = CTk.CTkRadioButton(self.sidebar_frame, text="Agglomerative", variable=self.cluster_radio_sel, value=1, command=self.clustering_select_event)
         self.agglo_cluster_radio.grid(row=14, column=0, pady=10, padx=30, sticky="w")
+        self.neighbors_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=list(NEIGHBORS), command=self.clustering_settings_event)
+        self.neighbors_menu.grid(row=15, column=0, padx=20, pady=(0, 10))
         self.kmeans_cluster_radio = CTk.CTkRadioButton(self.sidebar_frame, text="K-Means", variable=self.cluster_radio_sel, value=2, command=self.clustering_select_event)
-        self.kmeans_cluster_radio.grid(row=15, column=0, pady=10, padx=30, sticky="w")
+        self.kmeans_cluster_radio.grid(row=16, column=0, pady=10, padx=30, sticky="w")
+        self.embedding_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=list(EMBEDDINGS), command=self.clustering_settings_event)
+        self.embedding_menu.grid(row=17, column=0, padx=20, pady=(0, 10))
+        self.kmedoids_cluster_radio = CTk.CTkRadioButton(self.sidebar_frame, text="K-Medoids", variable=self.cluster_radio_sel, value=4, command=self.clustering_select_event)
+        self.kmedoids_cluster_radio.grid(row=18, column=0, pady=10, padx=30, sticky="w")
         self.affinity_cluster_radio = CTk.CTkRadioButton(self.sidebar_frame, text="Affinity Propagation", variable=self.cluster_radio_sel, value=3, command=self.clustering_select_event)
-        self.affinity_cluster_radio.grid(row=16, column=0, pady=10, padx=30, sticky="w")
+        self.affinity_cluster_radio.grid(row=19, column=0, pady=10, padx=30, sticky="w")
+
+        self.timegap_settings_label = CTk.CTkLabel(self.sidebar_frame, text="Timegap Settings:", anchor="w")
+        self.timegap_settings_label.grid(row=20, column=0, padx=20, pady=(10, 0))
+        self.sparse_timegap_switch = CTk.CTkSwitch(self.sidebar_frame, text="Sparse Timegaps", command=self.timegap_settings_event)
+        self.sparse_timegap_switch.grid(row=21, column=0, pady=10, padx=30, sticky="w")
+        self.chunk_size_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=list(CHUNK_SIZES), command=self.timegap_settings_event)
+        self.chunk_size_menu.grid(row=22, column=0, padx=20, pady=(10, 0))
+        self.quantile_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=list(QUANTILES), command=self.timegap_settings_event)
+        self.quantile_menu.grid(row=23, column=0, padx=20, pady=(10, 0))
+        self.half_life_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=list(HALF_LIVES), command=self.timegap_settings_event)
+        self.half_life_menu.grid(row=24, column=0, padx=20, pady=(10, 0))
 
         self.ui_settings_label = CTk.CTkLabel(self.sidebar_frame, text="UI Settings:", anchor="w")
-        self.ui_settings_label.grid(row=17, column=0, padx=20, pady=(10, 0))
+        self.ui_settings_label.grid(row=25, column=0, padx=20, pady=(10, 0))
         self.appearance_mode_menu = CTk.CTkOptionMenu(self.sidebar_frame, values=["System", "Light", "Dark"], command=self.change_appearance_mode_event)
-        self.appearance_mode_menu.grid(row=18, column=0, padx=20, pady=(10, 20))
+        self.appearance_mode_menu.grid(row=26, column=0, padx=20, pady=(10, 20))
 
         # data info frame
         self.data_info_tab = CTk.CTkTabview(self, height=800, width=450)
@@ -231,6 +318,8 @@ class DeepRosaGUI(CTk.CTk):
         self.clear_list_btn = CTk.CTkButton(master=self.shopping_list_frame, text="Clear", width=70, fg_color="indianred1", command=self.clear_shopping_list)
         self.clear_list_btn.grid(row=3, column=1, padx=5, pady=5, sticky="nsew")
         self.pick_list_entry.bind("<Return>", self.pick_from_shopping_list)
+        self.sort_file_btn = CTk.CTkButton(master=self.shopping_list_frame, text="Sort File", command=self.sort_file_event)
+        self.sort_file_btn.grid(row=4, column=0, columnspan=2, padx=5, pady=5, sticky="nsew")
 
         # plot display frame
         self.plot_preview_frame = CTk.CTkFrame(self, height=100, width=520)
@@ -238,8 +327,14 @@ class DeepRosaGUI(CTk.CTk):
 
         # set default values
         self.appearance_mode_menu.set("System")
+        self.neighbors_menu.set(next(name for name, n_neighbors in NEIGHBORS.items() if n_neighbors == self.n_neighbors))
+        self.embedding_menu.set(next((name for name, n_components in EMBEDDINGS.items() if n_components == self.n_components),
+                                     f"K-Means on {self.n_components} Dimensions"))
         self.reset_event()
 
+        if snapshot_path is not None:
+            self.load_snapshot_event(snapshot_path)
+
 
 
     ####### UI EVENTS ######
@@ -286,6 +381,24 @@ class DeepRosaGUI(CTk.CTk):
     def clustering_select_event(self):
         self.cluster_sel = self.cluster_radio_sel.get()
 
+    def clustering_settings_event(self, *args):
+        self.n_neighbors = NEIGHBORS[self.neighbors_menu.get()]
+        # a number of dimensions given on the command line has no entry in the menu
+        self.n_components = EMBEDDINGS.get(self.embedding_menu.get(), self.n_components)
+
+    def timegap_settings_event(self, *args):
+        self.sparse_timegap = bool(self.sparse_timegap_switch.get())
+        self.chunk_size = CHUNK_SIZES[self.chunk_size_menu.get()]
+        # a quantile loaded from a snapshot may have no entry in the menu
+        self.quantile = QUANTILES.get(self.quantile_menu.get(), self.quantile)
+        self.half_life = HALF_LIVES.get(self.half_life_menu.get(), self.half_life)
+
+    def timegap_settings_state(self, state):
+        self.sparse_timegap_switch.configure(state=state)
+        self.chunk_size_menu.configure(state=state)
+        self.quantile_menu.configure(state=state)
+        self.half_life_menu.configure(state=state)
+
 
 
     ####### PRINT EVENTS ######
@@ -295,7 +408,7 @@ class DeepRosaGUI(CTk.CTk):
         self.general_text.configure(state='normal')
         self.general_text.delete(1.0, 'end')
         self.general_text.insert('end', f"Total Items: {len(self.item_list)}\n")
-        self.general_text.insert('end', f"Total Pairs: {len([key for key in self.timegap_dict if self.timegap_dict[key] != self.default_timegap])}\n")
+        self.general_text.insert('end', f"Total Pairs: {np.count_nonzero(self.timegap_table.timegap != self.default_timegap)}\n")
         self.general_text.insert('end', f"Total Shoppers: {self.total_shoppers}\n")
         self.general_text.configure(state='disabled')
         
@@ -309,7 +422,7 @@ class DeepRosaGUI(CTk.CTk):
         # Print Timegaps
         self.timegaps_text.configure(state='normal')
         self.timegaps_text.delete(1.0, 'end')
-        for i, (key, value) in enumerate(self.timegap_dict.items()):
+        for i, (key, value) in enumerate(sorted(self.timegap_dict.items(), key=lambda x: x[1])):     #sort from lowest timegap
             item_x, item_y = key
             if value < self.default_timegap:
                 self.timegaps_text.insert('end', f"{i + 1}. {item_x}, {item_y} - {value:.2f}\n")
@@ -353,8 +466,10 @@ class DeepRosaGUI(CTk.CTk):
 
     def reset_event(self):
 
-        self.timegap_dict.clear()
+        self.timegap_table = PairTable([], self.default_timegap)
+        self.timegap_dict = {}
         self.cluster_dict.clear()
+        self.sort_model = SortModel({}, {})
         self.shopping_list.clear()
         self.timegap_matrix = np.array([])
         
@@ -405,29 +520,39 @@ class DeepRosaGUI(CTk.CTk):
         self.pick_list_entry.delete(0, 'end')
         self.pick_list_entry.configure(state='disabled')
         self.clear_list_btn.configure(state='disabled')
+        self.sort_file_btn.configure(state='disabled')
 
         self.cluster_radio_sel.set(1)
         self.clustering_select_event()
         self.agglo_cluster_radio.configure(state='disabled')
         self.agglo_cluster_radio.select()
         self.kmeans_cluster_radio.configure(state='disabled')
+        self.kmedoids_cluster_radio.configure(state='disabled')
         self.affinity_cluster_radio.configure(state='disabled')
+        self.timegap_settings_state('normal')
 
 
         self.toplevel_window = None
 
     def import_event(self):
         file_path = filedialog.askopenfilename(filetypes=[("CSV files", "*.csv")])
-        df = pd.read_csv(file_path, header=None)
-        self.item_list = sorted(df[(df.iloc[:, 2].apply(lambda x: isinstance(x, (int, float))) | \
-                                    df.iloc[:, 2].apply(lambda x: str(x).isdigit() or x == 'Good'))].iloc[:, 0].unique())
+        if self.chunk_size:
+            start_time = time.time()
+            self.timegap_table = PairTable([], self.default_timegap, sparse=self.sparse_timegap, half_life=self.half_life or None,
+                                           quantile=self.quantile or None)
+            self.timegap_table, self.total_shoppers, _ = add_recording(self.timegap_table, file_path, self.chunk_size)
+            self.item_list = self.timegap_table.items
+        else:
+            df = load_recording(file_path)
+            self.item_list = sorted(df.iloc[:, 0][good_status_mask(df.iloc[:, 2])].unique())
 
-        start_time = time.time()
-        self.timegap_dict, self.threshold_dict = initialize_timegap(self.item_list, self.default_timegap)
-        self.timegap_dict, self.total_shoppers = add_timegap(df, self.timegap_dict, self.threshold_dict, True) 
-        self.timegap_dict = normalize_timegaps(self.timegap_dict)
+            start_time = time.time()
+            self.timegap_table = PairTable(self.item_list, self.default_timegap, sparse=self.sparse_timegap, half_life=self.half_life or None,
+                                           quantile=self.quantile or None)
+            self.timegap_table, self.total_shoppers = add_timegap_table(df, self.timegap_table, True)
         #self.instances_dict = item_instances(self.timegap_dict)
-        self.timegap_dict = dict(sorted(self.timegap_dict.items(), key=lambda x: x[1]))     #sort from lowest timegap
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
         end_time = time.time()
         self.proximity_time = abs(start_time-end_time)
 
@@ -440,23 +565,40 @@ class DeepRosaGUI(CTk.CTk):
         self.sidebar_cluster_btn.configure(state='normal')
         self.sidebar_reset_btn.configure(state='normal')
         self.kmeans_cluster_radio.configure(state='normal')
+        self.kmedoids_cluster_radio.configure(state='normal')
         self.agglo_cluster_radio.configure(state='normal')
         self.affinity_cluster_radio.configure(state='normal')
+        self.timegap_settings_state('disabled')
 
 
     def cluster_event(self):
-        self.timegap_matrix = dict_to_matrix(self.item_list, self.timegap_dict)
+        if self.sparse_timegap:
+            self.timegap_matrix = table_to_sparse(self.timegap_table)
+        else:
+            self.timegap_matrix = table_to_matrix(self.timegap_table, condensed=True)
 
         start_time = time.time()
         if self.cluster_sel == 1:
-            self.cluster_dict, self.clustergap_dict, self.n_clusters= agglomerative_clustering(self.item_list, self.timegap_matrix, self.threshold_var, self.nclusters_var)
+            self.cluster_dict, self.clustergap_dict, self.n_clusters= agglomerative_clustering(self.item_list, self.timegap_matrix, self.threshold_var, self.nclusters_var, self.n_neighbors)
         elif self.cluster_sel == 2:
-            self.cluster_dict, self.n_clusters= kmeans_clustering(self.item_list, self.timegap_matrix, self.nclusters_var)
+            self.cluster_dict, self.n_clusters= kmeans_clustering(self.item_list, self.timegap_matrix, self.nclusters_var, self.n_components)
         elif self.cluster_sel == 3:
             self.cluster_dict, self.clustergap_dict, self.n_clusters= affinity_propagation_clustering(self.item_list, self.timegap_matrix, 0.9, 500, 15)
+        elif self.cluster_sel == 4:
+            # the slider starts at 0, while k-medoids needs from 1 to one cluster per item
+            n_clusters = min(max(self.nclusters_var, 1), len(self.item_list))
+            self.cluster_dict, self.clustergap_dict, self.n_clusters= kmedoids_clustering(self.item_list, self.timegap_matrix, n_clusters)
         
         end_time = time.time()
         self.clustering_time = abs(start_time-end_time)
+        self.sort_model = SortModel(self.cluster_dict, self.clustergap_dict, self.timegap_table.index)
+        self.show_clusters()
+
+        self.general_text.configure(state='normal')
+        self.general_text.insert('end', f"Time to cluster: {self.clustering_time:.2f}\n\n")
+        self.general_text.configure(state='disabled')
+
+    def show_clusters(self):
         self.print_cluster_timegaps()
 
         self.cluster_back_btn.configure(state='normal')
@@ -473,14 +615,61 @@ class DeepRosaGUI(CTk.CTk):
         self.general_text.insert('end', f"Total Clusters: {self.n_clusters}\n")
         self.general_text.configure(state='disabled')
 
-        self.general_text.configure(state='normal')
-        self.general_text.insert('end', f"Time to cluster: {self.clustering_time:.2f}\n\n")
-        self.general_text.configure(state='disabled')
-
         self.shopping_list_entry.configure(state='normal')
         self.sort_list_btn.configure(state='normal')
         self.pick_list_entry.configure(state='normal')
         self.clear_list_btn.configure(state='normal')
+        self.sort_file_btn.configure(state='normal')
+
+    def load_snapshot_event(self, snapshot_path):
+        # a directory of snapshots is resolved to the newest one in it
+        if not os.path.exists(os.path.join(snapshot_path, 'manifest.json')):
+            snapshot_path = latest_snapshot(snapshot_path)
+        if snapshot_path is None:
+            self.general_text.configure(state='normal')
+            self.general_text.insert('end', "No snapshot to load.\n\n")
+            self.general_text.configure(state='disabled')
+            return
+
+        start_time = time.time()
+        snapshot = load_snapshot(snapshot_path)
+
+        self.timegap_table = snapshot.table()
+        self.sparse_timegap = self.timegap_table.sparse
+        if self.sparse_timegap:
+            self.sparse_timegap_switch.select()
+        else:
+            self.sparse_timegap_switch.deselect()
+        self.quantile = self.timegap_table.quantile or 0
+        self.quantile_menu.set(next((name for name, quantile in QUANTILES.items() if quantile == self.quantile),
+                                    f"Cluster on {self.quantile:g} Quantile"))
+        self.half_life = self.timegap_table.half_life or 0
+        self.half_life_menu.set(next((name for name, half_life in HALF_LIVES.items() if half_life == self.half_life),
+                                     f"Half-Life of {self.half_life:g} Shoppers"))
+        self.item_list = self.timegap_table.items
+        self.total_shoppers = snapshot.manifest['total_shoppers']
+        self.timegap_dict = self.timegap_table.view()
+        self.threshold_dict = self.timegap_table.view(self.timegap_table.threshold, 0)
+
+        self.cluster_dict = snapshot.clusters()
+        self.clustergap_dict = snapshot.cluster_gaps()
+        self.sort_model = snapshot.sort_model()
+        self.n_clusters = snapshot.manifest['n_clusters']
+        end_time = time.time()
+        self.proximity_time = abs(start_time-end_time)
+
+        self.data_info_tab.configure(state='normal')
+        self.sidebar_import_btn.configure(state='disabled')
+        self.sidebar_cluster_slider.configure(state='normal')
+        self.sidebar_threshold_slider.configure(state='normal')
+        self.sidebar_cluster_btn.configure(state='normal')
+        self.sidebar_reset_btn.configure(state='normal')
+        self.kmeans_cluster_radio.configure(state='normal')
+        self.kmedoids_cluster_radio.configure(state='normal')
+        self.agglo_cluster_radio.configure(state='normal')
+        self.affinity_cluster_radio.configure(state='normal')
+        self.timegap_settings_state('disabled')
+        self.show_clusters()
         
 
     def plot_event(self):
@@ -501,7 +690,7 @@ class DeepRosaGUI(CTk.CTk):
                 self.print_shopping_list()
 
     def sort_shopping_list(self):
-        self.shopping_list = sort_shopping_list(None, self.shopping_list, self.clustergap_dict, self.cluster_dict)
+        self.shopping_list = self.sort_model.sort(None, self.shopping_list)
         self.print_shopping_list()
     
     def pick_from_shopping_list(self, key):
@@ -509,11 +698,37 @@ class DeepRosaGUI(CTk.CTk):
             if self.shopping_list:
                 item = self.pick_list_entry.get()
                 if item in self.shopping_list:
-                    self.shopping_list = sort_shopping_list(item, self.shopping_list, self.clustergap_dict, self.cluster_dict)
+                    self.shopping_list = self.sort_model.sort(item, self.shopping_list)
                     self.shopping_list.remove(item)
                     self.print_shopping_list()
                     self.pick_list_entry.delete(0, 'end')
  
+    def sort_file_event(self):
+        # every line of the file is a shopping list of comma-separated items
+        file_path = filedialog.askopenfilename(filetypes=[("CSV files", "*.csv")])
+        if not file_path:
+            return
+
+        with open(file_path, newline='') as input_csv:
+            shopping_lists = [[item.strip() for item in row if item.strip()] for row in csv.reader(input_csv)]
+
+        start_time = time.time()
+        ids, offsets = self.sort_model.encode_lists(shopping_lists)
+        order = sort_shopping_lists(ids, offsets, self.sort_model)
+        items = [item for shopping_list in shopping_lists for item in shopping_list]
+        sorted_items = [items[i] for i in order]
+        sort_time = time.time() - start_time
+
+        sorted_path = os.path.splitext(file_path)[0] + "_sorted.csv"
+        with open(sorted_path, 'w', newline='') as output_csv:
+            writer = csv.writer(output_csv)
+            for first, last in zip(offsets[:-1], offsets[1:]):
+                writer.writerow(sorted_items[first:last])
+
+        self.general_text.configure(state='normal')
+        self.general_text.insert('end', f"Sorted {len(shopping_lists)} shopping lists in {sort_time:.2f}s to {sorted_path}\n\n")
+        self.general_text.configure(state='disabled')
+
     def clear_shopping_list(self):
         self.shopping_list.clear()
         self.shopping_list_text.configure(state='normal')
@@ -6,14 +6,69 @@ Main running script for DeepRosa experimenting application.
 Authors: Johnfil Initan, Vince Abella, Jake Perez
 
 """
-from Server.serverConnection import start_server
+import argparse
+
+from Server.serverConnection import start_server, start_workers
 from Views.MainView import DeepRosaGUI
 
 def dprosa():
-    
-    app = DeepRosaGUI()
+
+    parser = argparse.ArgumentParser(description="Deep Rosa experimenting application.")
+    parser.add_argument('snapshot_path', nargs='?', default=None,
+                        help="a saved model snapshot, or a directory of snapshots to load the newest one from, "
+                             "to skip importing and clustering")
+    parser.add_argument('--server', action='store_true',
+                        help="also start the server for the devices, serving the snapshot until a clustering is requested")
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help="with --server, serve only sorting, from N processes sharing the snapshot, which is "
+                             "then required. Each worker writes its own sort time file")
+    parser.add_argument('--watch', type=float, default=0, metavar='SECONDS',
+                        help="with --server, fold new and growing recordings into the model every SECONDS seconds")
+    parser.add_argument('--components', type=int, default=0, metavar='N',
+                        help="run the K-Means of the app on an embedding of the items in N dimensions instead of on "
+                             "their timegaps, which is faster for large catalogs")
+    parser.add_argument('--neighbors', type=int, default=0, metavar='K',
+                        help="with --server, only merge items along the K shortest observed timegaps of every item, "
+                             "so that agglomerative clustering grows with the number of items times K")
+    parser.add_argument('--sparse', action='store_true',
+                        help="with --server, only store the observed pairs of items, for catalogs too large for a "
+                             "dense matrix")
+    parser.add_argument('--chunk-size', type=int, default=0, metavar='ROWS',
+                        help="with --server, read the recordings this many rows at a time, so that memory does not "
+                             "grow with their size")
+    parser.add_argument('--half-life', type=float, default=0, metavar='SHOPPERS',
+                        help="with --server, cluster on means of the timegaps that decay by half every SHOPPERS "
+                             "shoppers, so that the latest store layout dominates")
+    parser.add_argument('--quantile', type=float, default=0, metavar='Q',
+                        help="with --server, cluster on this quantile of the timegaps of every pair, e.g. 0.5 for "
+                             "the median, instead of on their mean")
+    args = parser.parse_args()
+
+    if not 0 <= args.quantile < 1:
+        parser.error("--quantile must be from 0 to below 1")
+
+    if args.half_life < 0:
+        parser.error("--half-life must not be negative")
+
+    if args.neighbors < 0:
+        parser.error("--neighbors must not be negative")
+
+    if args.components < 0:
+        parser.error("--components must not be negative")
+
+    if args.workers and not (args.server and args.snapshot_path):
+        parser.error("--workers needs --server and a snapshot")
+
+    if args.workers:
+        start_workers(args.snapshot_path, args.workers)
+    elif args.server:
+        start_server(args.snapshot_path, args.watch, settings={'sparse_timegap': args.sparse, 'n_neighbors': args.neighbors,
+                                                               'chunk_size': args.chunk_size,
+                                                               'half_life': args.half_life,
+                                                               'quantile': args.quantile})
+
+    app = DeepRosaGUI(args.snapshot_path, args.components)
     app.mainloop()
 
 if __name__ == "__main__":
-    #start_server()
-    dprosa()
\ No newline at end of file
+    dprosa()
@@ -0,0 +1,163 @@
+"""
+Recording Ingestion Tests // dprosa
+
+These tests check that every way of reading the CSV recordings
+gives the same pair table as reading them compiled into a single
+CSV file, which is how the timegaps were first computed.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from Models._dprosa import add_timegap_table, good_status_mask
+from Models._ingest import \
+    add_recording, compile_recordings, load_recording, read_appended, read_recording, read_recordings
+from Models._pairs import PairTable
+
+# rows as the devices write them, with quoted items, CRLF line ends and null bytes
+RECORDINGS = [
+    b'"milk",0,"Good"\r\n\x00\x00'
+    b'"bread",12.5,"Good"\r\n'
+    b'"eggs",30.25,"1"\r\n'
+    b'"bread",41,"Good"\r\n'
+    b'"cheese",0,"Bad"\r\n'      # a bad row with a timestamp of 0 does not start a list
+    b'"butter",55.75,"Good"\r\n'
+    b'"milk",0,"Good"\r\n'
+    b'"eggs",8,"Good"\r\n'
+    b'"rice",90,"Bad"\r\n'
+    b'"butter",21.5,"Good"\r\n',
+
+    b'"bread",0,"Good"\r\n'
+    b'"milk",15,"Good"\r\n'
+    b'"eggs",0,"Bad"\r\n'
+    b'"butter",27.5,"2"\r\n'
+    b'"eggs",33,"Good"\r\n'
+    b'"rice",0,"Good"\r\n\x00'
+    b'"milk",19,"Good"\r\n'
+    b'"bread",40.5,"Good"\r\n'
+    b'"eggs",52,"Good"\r\n',
+]
+
+# arrays that every way of reading must agree on
+COMPARED = ['timegap', 'count', 'last', 'threshold', 'decayed', 'weight', 'markers', 'seen']
+
+
+def new_table(L=()):
+    return PairTable(list(L), 10000, half_life=2, quantile=0.5)
+
+
+class TestIngestion(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_paths = []
+        for i, data in enumerate(RECORDINGS):
+            file_path = os.path.join(self.directory, f"recording_{i}.csv")
+            with open(file_path, 'wb') as recording:
+                recording.write(data)
+            self.file_paths.append(file_path)
+
+        # the timegaps of the recordings compiled into a single CSV file
+        compiled_path = os.path.join(self.directory, 'compiled.csv')
+        compile_recordings(self.file_paths, compiled_path)
+        df = read_recording(compiled_path)
+        self.expected, self.expected_lists = add_timegap_table(
+            df, new_table(sorted(df.iloc[:, 0][good_status_mask(df.iloc[:, 2])].unique())), True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertSameTable(self, PT, n_lists):
+        self.assertEqual(PT.items, self.expected.items)
+        self.assertEqual(n_lists, self.expected_lists)
+        self.assertEqual(PT.n_lists, self.expected.n_lists)
+        for name in COMPARED:
+            np.testing.assert_allclose(getattr(PT, name), getattr(self.expected, name), err_msg=name)
+
+    def test_compiled_lists(self):
+        # the bad rows with a timestamp of 0 do not start lists
+        self.assertEqual(self.expected_lists, 4)
+        self.assertNotIn('cheese', self.expected.items)
+
+    def test_read_recordings(self):
+        for max_workers in (1, 2):
+            partial = read_recordings(self.file_paths, max_workers)
+            PT, n_lists = partial.add_to_table(new_table(partial.items.tolist()))
+            self.assertSameTable(PT, n_lists)
+
+    def test_read_recordings_cached(self):
+        # the second read comes from the column cache
+        for _ in range(2):
+            partial = read_recordings(self.file_paths, 1)
+            PT, n_lists = partial.add_to_table(new_table(partial.items.tolist()))
+            self.assertSameTable(PT, n_lists)
+
+    def test_add_recording(self):
+        for chunk_size in (1, 3, 100000):
+            PT, n_lists = new_table(), 0
+            for file_path in self.file_paths:
+                PT, file_lists, _ = add_recording(PT, file_path, chunk_size)
+                n_lists += file_lists
+            self.assertSameTable(PT, n_lists)
+
+    def test_add_timegap_table(self):
+        PT, n_lists = new_table(), 0
+        for file_path in self.file_paths:
+            df = load_recording(file_path, cache=False)
+            PT.add_items(df.iloc[:, 0][good_status_mask(df.iloc[:, 2])].tolist())
+            PT, file_lists = add_timegap_table(df, PT, True)
+            n_lists += file_lists
+        self.assertSameTable(PT, n_lists)
+
+    def test_read_appended(self):
+        # a recording read as it grows, one byte at a time
+        grown = os.path.join(self.directory, 'grown.csv')
+        data = b''.join(RECORDINGS)
+        open(grown, 'wb').close()
+
+        PT, n_lists, offset = new_table(), 0, 0
+        for end in range(1, len(data) + 1):
+            with open(grown, 'ab') as recording:
+                recording.write(data[end - 1:end])
+            df, offset = read_appended(grown, offset, final=end == len(data))
+            if len(df):
+                PT.add_items(df.iloc[:, 0][good_status_mask(df.iloc[:, 2])].tolist())
+                PT, file_lists = add_timegap_table(df, PT, True)
+                n_lists += file_lists
+        self.assertSameTable(PT, n_lists)
+
+    def test_read_appended_inside_a_line(self):
+        # an offset inside a line skips to the next list instead of failing
+        offset = RECORDINGS[0].index(b'"eggs"') + 3
+        df, offset = read_appended(self.file_paths[0], offset, final=True)
+        self.assertEqual(df.iloc[0, 0], 'milk')
+        self.assertEqual(df.iloc[0, 1], 0)
+        self.assertEqual(offset, len(RECORDINGS[0]))
+
+    def test_read_appended_final_partial_line(self):
+        # a final read leaves a line that is still being written
+        partial = os.path.join(self.directory, 'partial.csv')
+        with open(partial, 'wb') as recording:
+            recording.write(b'"milk",0,"Good"\n"bread",12.5,"Good"\n"eggs",3')
+        df, offset = read_appended(partial, 0, final=True)
+        self.assertEqual(df.iloc[:, 0].tolist(), ['milk', 'bread'])
+        self.assertEqual(offset, len(b'"milk",0,"Good"\n"bread",12.5,"Good"\n'))
+
+    def test_numeric_status(self):
+        # every row of a numeric status column is good, as are missing statuses
+        status = pd.Series([1, 1, None, -1, 0], dtype=float)
+        self.assertTrue(good_status_mask(status).all())
+        status = pd.Series(['Good', None, 'Bad', '-1', '5'])
+        self.assertEqual(good_status_mask(status).tolist(), [True, True, False, False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+Pair Table Tests // dprosa
+
+These tests check that the quantile markers kept for every pair
+of items are those of the P² algorithm folding the observations
+of the pair one by one, however they are batched.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import unittest
+
+import numpy as np
+
+from Models._pairs import SCALAR_PAIRS, PairTable, pair_index
+
+
+def p2_quantile(observations, p):
+    '''
+    P² estimate of the p-th quantile of a stream of observations,
+    with the markers moved toward positions 1 + (n - 1) * dn.
+    '''
+    if len(observations) < 5:
+        return float(np.quantile(observations, p))
+
+    q, n, dn = sorted(observations[:5]), [1, 2, 3, 4, 5], [0, p / 2, p, (1 + p) / 2, 1]
+    for seen, x in enumerate(observations[5:], 6):
+        q[0], q[4] = min(q[0], x), max(q[4], x)
+        k = (x >= q[1]) + (x >= q[2]) + (x >= q[3])
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in (1, 2, 3):
+            d = 1 + (seen - 1) * dn[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                s = 1 if d >= 0 else -1
+                qp = q[i] + s / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + s) * (q[i + 1] - q[i]) / (n[i + 1] - n[i]) +
+                    (n[i + 1] - n[i] - s) * (q[i] - q[i - 1]) / (n[i] - n[i - 1]))
+                if not q[i - 1] < qp < q[i + 1]:
+                    qp = q[i] + s * (q[i + s] - q[i]) / (n[i + s] - n[i])
+                q[i] = qp
+                n[i] += s
+    return q[2]
+
+
+class TestQuantiles(unittest.TestCase):
+
+    def assertP2(self, PT, observed):
+        estimates = PT.quantile_timegap()
+        for P, observations in observed.items():
+            self.assertAlmostEqual(estimates[PT.slots(np.array([P]))[0]], p2_quantile(observations, PT.quantile),
+                                   places=9, msg=str(P))
+
+    def test_batches(self):
+        # batches of 33 to 1000 observations, with busy pairs that reach the pair-by-pair folding
+        rng = np.random.default_rng(0)
+        items = [str(i) for i in range(12)]
+        for sparse in (False, True):
+            for p in (0.5, 0.9):
+                PT, observed = PairTable(items, 10000, sparse=sparse, quantile=p), {}
+                for _ in range(40):
+                    m = int(rng.integers(33, 1001))
+                    I = rng.integers(0, 12, m)
+                    J = (I + rng.integers(1, 12, m)) % 12
+                    busy = rng.random(m) < 0.3
+                    I[busy], J[busy] = 0, 1
+                    P, D = pair_index(I, J, 12), rng.lognormal(3, 0.8, m)
+                    PT.add_timegaps(P, D)
+                    for pair, timegap in zip(P.tolist(), D.tolist()):
+                        observed.setdefault(pair, []).append(timegap)
+                self.assertP2(PT, observed)
+
+    def test_single_pair(self):
+        # one pair only, so every batch is folded pair by pair
+        rng = np.random.default_rng(1)
+        PT, observations = PairTable(['a', 'b'], 10000, quantile=0.9), []
+        for _ in range(30):
+            D = rng.lognormal(3, 0.8, int(rng.integers(1, 1001)))
+            PT.add_timegaps(np.zeros(len(D), dtype=np.int64), D)
+            observations.extend(D.tolist())
+        self.assertP2(PT, {0: observations})
+
+    def test_wide_rounds(self):
+        # more pairs than SCALAR_PAIRS, so the first rounds are taken at once
+        rng = np.random.default_rng(2)
+        items = [str(i) for i in range(40)]
+        PT, observed = PairTable(items, 10000, quantile=0.5), {}
+        I = rng.integers(0, 40, 20000)
+        J = (I + rng.integers(1, 40, 20000)) % 40
+        P, D = pair_index(I, J, 40), rng.exponential(30, 20000)
+        self.assertGreater(len(np.unique(P)), SCALAR_PAIRS)
+        PT.add_timegaps(P, D)
+        for pair, timegap in zip(P.tolist(), D.tolist()):
+            observed.setdefault(pair, []).append(timegap)
+        self.assertP2(PT, observed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+"""
+Recording Watcher Tests // dprosa
+
+These tests check that the recordings folded into the server model
+as they are written, by the watcher and by updates, give the same
+timegaps as reading them whole once they are complete.
+
+Authors: Johnfil Initan, Vince Abella, Jake Perez
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import Server.serverConnection as sc
+from Models._ingest import read_recording
+from Server.serverDprosa import serverDprosa
+from tests.test_ingest import RECORDINGS
+
+
+class Client:
+    '''
+    Stands in for the socket of a device, keeping the replies.
+    '''
+    def __init__(self):
+        self.replies = []
+
+    def send(self, data):
+        self.replies.append(data.decode('utf-8'))
+
+
+class TestWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'CSVRecordings'))
+        self.file_path = os.path.join(self.directory, 'CSVRecordings', 'recording.csv')
+        self.data = b''.join(RECORDINGS)
+
+        # the timegaps of the complete recording read whole
+        with open(self.file_path, 'wb') as recording:
+            recording.write(self.data)
+        self.expected = serverDprosa()
+        self.expected_lists = self.expected.addShoppingLists(read_recording(self.file_path))
+        os.remove(self.file_path)
+
+        sc.server_model, sc.global_directory = serverDprosa(), self.directory
+
+    def tearDown(self):
+        sc.server_model, sc.global_directory = None, ''
+        shutil.rmtree(self.directory)
+
+    def assertSameModel(self, model):
+        self.assertEqual(model.total_shoppers, self.expected_lists)
+        PT, expected = model.timegap_table, self.expected.timegap_table
+        self.assertEqual(dict(PT.view(PT.count, 0)), dict(expected.view(expected.count, 0)))
+        timegaps, expected_timegaps = dict(PT.view()), dict(expected.view())
+        self.assertEqual(timegaps.keys(), expected_timegaps.keys())
+        for pair, timegap in expected_timegaps.items():
+            np.testing.assert_allclose(timegaps[pair], timegap, err_msg=str(pair))
+
+    def update(self):
+        client = Client()
+        sc.perform_update(client, self.file_path)
+        self.assertEqual(client.replies, ["DONE."])
+
+    def test_paused_growth(self):
+        # the recording stalls for several scans inside lines and inside lists
+        rng = np.random.default_rng(0)
+        cuts = np.sort(rng.choice(np.arange(1, len(self.data)), 12, replace=False))
+        cuts = [0, *cuts, len(self.data)]
+
+        open(self.file_path, 'wb').close()
+        for start, end in zip(cuts[:-1], cuts[1:]):
+            with open(self.file_path, 'ab') as recording:
+                recording.write(self.data[start:end])
+            for _ in range(3):
+                sc.scan_recordings(self.directory)
+
+        # a pause alone does not fold the last list, which the update of the device does
+        self.assertEqual(sc.server_model.total_shoppers, self.expected_lists - 1)
+        self.update()
+        self.assertSameModel(sc.server_model)
+
+    def test_update_after_scan(self):
+        # a recording folded by the watcher and then by an update is only counted once
+        with open(self.file_path, 'wb') as recording:
+            recording.write(self.data)
+        sc.scan_recordings(self.directory)
+        self.update()
+        self.assertEqual(sc.scan_recordings(self.directory), 0)
+        self.assertSameModel(sc.server_model)
+
+    def test_scan_after_update(self):
+        with open(self.file_path, 'wb') as recording:
+            recording.write(self.data)
+        self.update()
+        self.assertEqual(sc.scan_recordings(self.directory), 0)
+        self.update()
+        self.assertSameModel(sc.server_model)
+
+
+if __name__ == '__main__':
+    unittest.main()